@@ -0,0 +1,195 @@
+"""Локальная замена Marzban API для бенчмарков
+
+Реализует эндпоинты, которые использует бот: /api/admin/token, /api/user,
+/api/user/{username}, /api/user/{username}/reset и /api/users (offset/limit).
+Задержка, разброс и доля ошибок настраиваются.
+
+Отдельный запуск:
+    python -m benchmarks.fake_marzban --port 8000 --users 10000 --latency-ms 20
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from aiohttp import web
+
+GB = 1024 ** 3
+
+# Публичный ключ Reality фейковой панели (в ссылках) и ее inbound
+REALITY_PUBLIC_KEY = "hSDwCYkwp1R0i33ctD73Wg2_Og0mOBr066SpjqqbTmo"
+INBOUNDS = (("VLESS + Reality", 443), ("VLESS + Reality Slow", 8443))
+
+def make_links(username: str, user_id: str, inbounds: dict) -> list:
+    """Ссылки пользователя по его inbound (как их формирует панель)"""
+    return [
+        f"vless://{user_id}@127.0.0.1:{dict(INBOUNDS)[tag]}?security=reality&type=tcp&headerType=none"
+        f"&flow=xtls-rprx-vision&fp=chrome&sni=www.google.com&pbk={REALITY_PUBLIC_KEY}&sid=ab12#{username}"
+        for tag in inbounds.get("vless", []) if tag in dict(INBOUNDS)
+    ]
+
+def make_token(ttl: int) -> str:
+    """JWT-подобный токен с exp (подпись не проверяется)"""
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    return f'{part({"alg": "HS256", "typ": "JWT"})}.{part({"sub": "admin", "exp": int(time.time()) + ttl})}.fake'
+
+class FakeMarzban:
+    """Состояние фейковой панели и параметры деградации"""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 token_ttl: int = 86400, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.users = {}
+        self._ordered = []  # порядок для /api/users без копирования всего словаря на каждую страницу
+        self.requests = 0
+
+    def seed_users(self, count: int, limited_fraction: float = 0.01, prefix: str = "user_"):
+        """Создать count пользователей; часть из них - в статусе limited"""
+        expire = int(time.time()) + 30 * 86400
+        for i in range(count):
+            username = f"{prefix}{i}"
+            limited = self.random.random() < limited_fraction
+            data_limit = 200 * GB
+            self._add(self._new_user(
+                username,
+                data_limit=data_limit,
+                used_traffic=data_limit if limited else self.random.randint(0, 150) * GB,
+                status="limited" if limited else "active",
+                expire=expire
+            ))
+
+    def _add(self, user):
+        self.users[user["username"]] = user
+        self._ordered.append(user)
+
+    def _new_user(self, username, data_limit=0, used_traffic=0, status="active", expire=None,
+                  inbounds=None, proxies=None):
+        user_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, username))
+        proxies = proxies or {"vless": {"flow": "xtls-rprx-vision"}}
+        proxies.setdefault("vless", {}).setdefault("id", user_id)
+        inbounds = inbounds or {"vless": ["VLESS + Reality"]}
+        return {
+            "username": username,
+            "status": status,
+            "used_traffic": used_traffic,
+            "lifetime_used_traffic": used_traffic,
+            "data_limit": data_limit,
+            "expire": expire,
+            "proxies": proxies,
+            "inbounds": inbounds,
+            "links": make_links(username, user_id, inbounds),
+            "subscription_url": f"/sub/{username}",
+            "note": None,
+            "created_at": "2024-01-01T00:00:00"
+        }
+
+    @web.middleware
+    async def degrade(self, request, handler):
+        """Задержка, разброс и случайные 500"""
+        self.requests += 1
+        delay = self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"detail": "injected error"}, status=500)
+        return await handler(request)
+
+    async def token(self, request):
+        return web.json_response({"access_token": make_token(self.token_ttl), "token_type": "bearer"})
+
+    async def create_user(self, request):
+        data = await request.json()
+        username = data["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        user = self._new_user(
+            username,
+            data_limit=data.get("data_limit") or 0,
+            expire=data.get("expire"),
+            inbounds=data.get("inbounds"),
+            proxies=data.get("proxies")
+        )
+        self._add(user)
+        return web.json_response(user)
+
+    async def get_user(self, request):
+        user = self.users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def modify_user(self, request):
+        user = self.users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        data = await request.json()
+        for field in ("proxies", "inbounds", "data_limit", "expire"):
+            if field in data:
+                user[field] = data[field]
+        user["links"] = make_links(
+            user["username"], (user["proxies"] or {}).get("vless", {}).get("id", ""), user["inbounds"] or {}
+        )
+        if user["status"] == "limited" and (not user["data_limit"] or user["used_traffic"] < user["data_limit"]):
+            user["status"] = "active"
+        return web.json_response(user)
+
+    async def delete_user(self, request):
+        user = self.users.pop(request.match_info["username"], None)
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        self._ordered.remove(user)
+        return web.json_response({})
+
+    async def reset_user(self, request):
+        user = self.users.get(request.match_info["username"])
+        if not user:
+            return web.json_response({"detail": "User not found"}, status=404)
+        user["used_traffic"] = 0
+        if user["status"] == "limited":
+            user["status"] = "active"
+        return web.json_response(user)
+
+    async def list_users(self, request):
+        offset = int(request.query.get("offset", 0))
+        limit = request.query.get("limit")
+        page = self._ordered[offset:offset + int(limit)] if limit else self._ordered[offset:]
+        return web.json_response({"users": page, "total": len(self._ordered)})
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.degrade])
+        app.router.add_post("/api/admin/token", self.token)
+        app.router.add_post("/api/user", self.create_user)
+        app.router.add_get("/api/user/{username}", self.get_user)
+        app.router.add_put("/api/user/{username}", self.modify_user)
+        app.router.add_delete("/api/user/{username}", self.delete_user)
+        app.router.add_post("/api/user/{username}/reset", self.reset_user)
+        app.router.add_get("/api/users", self.list_users)
+        return app
+
+def serve(port: int, users: int = 0, latency_ms: float = 0, jitter_ms: float = 0,
+          error_rate: float = 0, limited_fraction: float = 0.01):
+    """Запустить фейковую панель (блокирующий вызов, удобно как target процесса)"""
+    fake = FakeMarzban(latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate)
+    fake.seed_users(users, limited_fraction=limited_fraction)
+    web.run_app(fake.create_app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Marzban API для бенчмарков")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--users", type=int, default=0, help="Сколько пользователей создать")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="Доля ответов 500 (0..1)")
+    parser.add_argument("--limited-fraction", type=float, default=0.01)
+    args = parser.parse_args()
+    serve(args.port, args.users, args.latency_ms, args.jitter_ms, args.error_rate, args.limited_fraction)
+
+if __name__ == "__main__":
+    main()
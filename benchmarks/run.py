@@ -0,0 +1,305 @@
+"""Бенчмарки MarzbanAPI, database.py, check_limits_task и обработчиков Web App
+
+Для каждого размера базы поднимается фейковый Marzban (отдельный процесс) и временная
+SQLite-база с тем же числом пользователей. Результат пишется в JSON, чтобы сравнивать прогоны:
+
+    python -m benchmarks.run --users 10000 100000 --latency-ms 5 --jitter-ms 2
+    python -m benchmarks.run --users 10000 --compare benchmarks/results/bench-20240101-120000.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# config.py читает окружение при импорте - заполняем до импорта модулей бота
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("TELEGRAM_ADMIN_ID", "0")
+os.environ.setdefault("MARZBAN_USERNAME", "admin")
+os.environ.setdefault("MARZBAN_PASSWORD", "admin")
+
+from benchmarks import fake_marzban
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def latency_summary(latencies, elapsed):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "ops_per_s": round(len(latencies) / elapsed, 1)
+    }
+
+async def measure(make_call, count, concurrency):
+    """Выполнить count вызовов с заданным параллелизмом; вернуть p50/p99 и пропускную способность"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await make_call(i)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    result = latency_summary(latencies, time.perf_counter() - started)
+    result["errors"] = errors
+    return result
+
+async def wait_for_server(url, timeout=600):
+    import aiohttp
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.post(f"{url}/api/admin/token") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Фейковый Marzban не запустился")
+
+class FakeBot:
+    """Bot с send_message без сети"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+async def bench_scale(users, args):
+    """Все замеры для одного размера базы"""
+    import database
+    import scheduler
+    from marzban_api import MarzbanAPI
+    from notifier import NotificationDispatcher
+
+    result = {"users": users}
+    rng = random.Random(0)
+
+    # База: пользователи с теми же username, что и в фейковом Marzban
+    await database.init_db()
+    # Регрессия индексов проваливает бенчмарк (при старте бота это только предупреждение)
+    async with database.connection() as db:
+        problems = await database.check_query_plans(db)
+    assert not problems, "Запросы не используют индексы:\n" + "\n".join(problems)
+    started = time.perf_counter()
+    async with database.connection() as db:
+        batch = 10000
+        for offset in range(0, users, batch):
+            await db.executemany(
+                "INSERT INTO users (telegram_id, username, tariff_type, created_at) VALUES (?, ?, 'base', ?)",
+                [(i, f"user_{i}", datetime.now()) for i in range(offset, min(users, offset + batch))]
+            )
+        await db.commit()
+    result["db_seed_rows_per_s"] = round(users / (time.perf_counter() - started), 1)
+
+    # Пропускная способность database.py
+    ids = [rng.randrange(users) for _ in range(args.requests)]
+    result["db"] = {
+        "get_user_by_telegram_id": await measure(
+            lambda i: database.get_user_by_telegram_id(ids[i]), args.requests, args.concurrency
+        ),
+        "add_transaction": await measure(
+            lambda i: database.add_transaction(ids[i], 99, "extra_gb"), args.requests // 2, args.concurrency
+        ),
+        "get_user_transactions": await measure(
+            lambda i: database.get_user_transactions(ids[i]), args.requests // 2, args.concurrency
+        )
+    }
+    started = time.perf_counter()
+    await database.update_last_check_bulk(range(users))
+    result["db"]["update_last_check_bulk_s"] = round(time.perf_counter() - started, 3)
+
+    # Вызовы MarzbanAPI
+    marzban = MarzbanAPI()
+    await marzban.start()
+    result["marzban"] = {
+        "get_user_uncached": await measure(
+            lambda i: marzban.get_user(f"user_{ids[i]}", use_cache=False), args.requests, args.concurrency
+        ),
+        "get_user_cached": await measure(
+            lambda i: marzban.get_user(f"user_{ids[i]}"), args.requests, args.concurrency
+        ),
+        "get_user_config": await measure(
+            lambda i: marzban.get_user_config(f"user_{ids[i]}"), args.requests, args.concurrency
+        ),
+        "add_traffic": await measure(
+            lambda i: marzban.add_traffic(f"user_{ids[i]}", 100), args.requests // 2, args.concurrency
+        )
+    }
+
+    # Полный проход check_limits_task
+    bot = FakeBot()
+    notifier = NotificationDispatcher(bot, global_rate=1e9, per_chat_rate=1e9)
+    await notifier.start()
+    scheduler.set_bot_and_marzban(bot, marzban, notifier)
+
+    started = time.perf_counter()
+    await scheduler.check_limits_task()
+    duration = time.perf_counter() - started
+    await notifier._queue.join()
+
+    # Пиковая память - отдельным проходом: tracemalloc замедляет выполнение
+    tracemalloc.start()
+    await scheduler.check_limits_task()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result["sweep"] = {
+        "duration_s": round(duration, 3),
+        "users_per_s": round(users / duration, 1) if duration else None,
+        "peak_python_mem_mb": round(peak / 1024 / 1024, 2),
+        "notifications": bot.sent
+    }
+
+    # Обработчики Web App поверх того же фейкового Marzban
+    from aiohttp.test_utils import TestClient, TestServer
+    import webapp_api
+    async with TestClient(TestServer(webapp_api.create_app())) as client:
+        async def status(i):
+            response = await client.get(f"/api/user/status?telegram_id={ids[i]}")
+            await response.read()
+        result["handlers"] = {
+            "api_user_status": await measure(status, args.requests, args.concurrency)
+        }
+
+    await notifier.stop()
+    await marzban.close()
+    await database.close_db()
+    return result
+
+def bench_in_workdir(users, args, workdir):
+    """Замеры в отдельном процессе: у каждого размера свои синглтоны модулей и свой пик RSS"""
+    # DB_PATH относительный - база создается во временном каталоге
+    os.chdir(workdir)
+    result = asyncio.run(bench_scale(users, args))
+    result["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+def run_scale(users, args, port):
+    url = f"http://127.0.0.1:{port}"
+    server = multiprocessing.Process(
+        target=fake_marzban.serve,
+        kwargs={
+            "port": port, "users": users, "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms, "error_rate": args.error_rate
+        },
+        daemon=True
+    )
+    server.start()
+    workdir = tempfile.mkdtemp(prefix="miravpn-bench-")
+    try:
+        asyncio.run(wait_for_server(url))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            return pool.submit(bench_in_workdir, users, args, workdir).result()
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def flatten(data, prefix=""):
+    """{"a": {"b": 1}} -> {"a.b": 1} для сравнения прогонов"""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(current, previous_path):
+    """Напечатать изменения метрик относительно предыдущего прогона"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    previous_by_users = {run["users"]: flatten(run) for run in previous["runs"]}
+    for run in current["runs"]:
+        before = previous_by_users.get(run["users"])
+        if not before:
+            continue
+        print(f"\n=== {run['users']} пользователей: изменения относительно {previous_path}")
+        for name, value in flatten(run).items():
+            old = before.get(name)
+            if old in (None, 0) or name == "users":
+                continue
+            print(f"{name:55} {old:>12} -> {value:>12} ({(value - old) / old * 100:+.1f}%)")
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота на фейковом Marzban")
+    parser.add_argument("--users", type=int, nargs="+", default=[10000], help="Размеры базы")
+    parser.add_argument("--requests", type=int, default=2000, help="Запросов на замер задержки")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Задержка фейкового Marzban")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0, help="Доля ответов 500 (0..1)")
+    parser.add_argument("--output", help="Файл результатов (по умолчанию benchmarks/results/bench-<время>.json)")
+    parser.add_argument("--compare", help="Предыдущий файл результатов для сравнения")
+    args = parser.parse_args()
+
+    # Порт один на все размеры: config.py читает MARZBAN_API_URL один раз
+    port = free_port()
+    os.environ["MARZBAN_API_URL"] = f"http://127.0.0.1:{port}"
+
+    runs = []
+    for users in args.users:
+        print(f"Бенчмарк: {users} пользователей...", file=sys.stderr)
+        runs.append(run_scale(users, args, port))
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "runs": runs
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"Результаты записаны в {output}", file=sys.stderr)
+
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
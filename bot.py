@@ -1,20 +1,36 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+import multiprocessing
+import os
+import secrets
+import tempfile
+from aiohttp import web
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.filters import Command, CommandObject
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, FSInputFile, BufferedInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from config import (
-    TELEGRAM_BOT_TOKEN, SERVER_IP,
+    TELEGRAM_BOT_TOKEN, TELEGRAM_ADMIN_ID, SERVER_IP,
     BASE_TARIFF_GB, BASE_TARIFF_DAYS, BASE_TARIFF_PRICE,
-    EXTRA_GB_AMOUNT, EXTRA_GB_PRICE, FREE_MODE_SPEED_MBPS
+    EXTRA_GB_AMOUNT, EXTRA_GB_PRICE, FREE_MODE_SPEED_MBPS,
+    METRICS_HOST, METRICS_PORT, PROFILE_SIGNAL_SECONDS,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, BOT_WORKERS,
+    BULK_MAX_USERS
 )
 from marzban_api import MarzbanAPI
 from database import (
-    init_db, get_user_by_telegram_id, create_user as db_create_user,
-    update_user_tariff, enable_free_mode, add_transaction
+    init_db, close_db, run_backfills, get_user_by_telegram_id, create_user as db_create_user,
+    update_user_tariff, enable_free_mode, add_transaction, get_revenue_summary, get_revenue_by_day
 )
-from scheduler import start_scheduler, set_bot_and_marzban
+from scheduler import start_scheduler, set_bot_and_marzban, seed_usage_tracker
+from notifier import NotificationDispatcher
+from metrics import start_metrics_server, add_public_metrics_route
+from leader import LeaderLock
+from profiler import profiler
+from export import EXPORTS, FORMATS, export_to_file, gzip_file
+from qr import qr_cache
+from provisioning import provision_users, parse_telegram_ids, summarize, report_csv
 from datetime import datetime, timedelta
 
 logging.basicConfig(level=logging.INFO)
@@ -22,6 +38,21 @@ bot = Bot(token=TELEGRAM_BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 marzban = MarzbanAPI()
+notifier = NotificationDispatcher(bot)
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Профилировать выборку апдейтов, стеки группируются по имени обработчика"""
+    
+    async def __call__(self, handler, event, data):
+        if not profiler.should_profile():
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", None) or type(event).__name__
+        with profiler.track(name):
+            return await handler(event, data)
+
+dp.message.middleware(ProfilingMiddleware())
+dp.callback_query.middleware(ProfilingMiddleware())
 
 async def create_vpn_key(message: types.Message, telegram_id: int):
     """Создание VPN ключа с автоматической генерацией username"""
@@ -38,7 +69,7 @@ async def create_vpn_key(message: types.Message, telegram_id: int):
     
     if user_data:
         # Сохраняем в БД
-        await db_create_user(telegram_id, username, "base")
+        await db_create_user(telegram_id, username, "base", node=marzban.placement(username))
         
         # Получаем конфигурацию
         config = await marzban.get_user_config(username)
@@ -76,7 +107,7 @@ async def cmd_start(message: types.Message):
     if user:
         # Пользователь уже существует - показываем статус
         username = user["username"]
-        marzban_user = await marzban.get_user(username)
+        marzban_user = await marzban.get_user_status(username)
         
         if marzban_user:
             used_gb = marzban_user.get("used_traffic", 0) / (1024**3)
@@ -137,6 +168,134 @@ async def cmd_start(message: types.Message):
             parse_mode="Markdown"
         )
 
+@dp.message(Command("profile"), F.from_user.id == TELEGRAM_ADMIN_ID)
+async def cmd_profile(message: types.Message, command: CommandObject):
+    """Профилировать все обработчики в течение N секунд (только администратор)"""
+    try:
+        seconds = float(command.args) if command.args else PROFILE_SIGNAL_SECONDS
+    except ValueError:
+        await message.answer("Использование: /profile [секунды]")
+        return
+    seconds = min(max(seconds, 1), 600)
+    
+    profiler.start_window(seconds)
+    await message.answer(f"⏱ Профилирую обработчики {seconds:g} сек...")
+    await asyncio.sleep(seconds)
+    
+    paths = profiler.flush()
+    if paths:
+        await message.answer("Профиль записан:\n" + "\n".join(paths))
+    else:
+        await message.answer("За это время не было обработанных апдейтов")
+
+@dp.message(Command("revenue"), F.from_user.id == TELEGRAM_ADMIN_ID)
+async def cmd_revenue(message: types.Message, command: CommandObject):
+    """Выручка за последние N дней (только администратор)"""
+    try:
+        days = int(command.args) if command.args else 30
+    except ValueError:
+        await message.answer("Использование: /revenue [дней]")
+        return
+    days = min(max(days, 1), 3660)
+    
+    summary = await get_revenue_summary(days)
+    by_day = await get_revenue_by_day(min(days, 7))
+    
+    lines = [
+        f"💰 Выручка за {days} дн. (с {summary['since']})\n",
+        f"Всего: {summary['amount']:.0f}₽, транзакций: {summary['count']}\n",
+        "По типу:"
+    ]
+    for name, totals in sorted(summary["by_type"].items(), key=lambda item: -item[1]["amount"]):
+        lines.append(f"• {name}: {totals['amount']:.0f}₽ ({totals['count']})")
+    lines.append("\nПо тарифу:")
+    for name, totals in sorted(summary["by_tariff"].items(), key=lambda item: -item[1]["amount"]):
+        lines.append(f"• {name}: {totals['amount']:.0f}₽ ({totals['count']})")
+    if by_day:
+        lines.append("\nПоследние дни:")
+        for row in by_day:
+            lines.append(f"• {row['day']}: {row['amount']:.0f}₽ ({row['count']})")
+    
+    # Без Markdown: названия типов и тарифов содержат "_"
+    await message.answer("\n".join(lines))
+
+# Лимит Bot API на отправку файлов
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+@dp.message(Command("export"), F.from_user.id == TELEGRAM_ADMIN_ID)
+async def cmd_export(message: types.Message, command: CommandObject):
+    """Выгрузка пользователей или транзакций файлом (только администратор)"""
+    args = (command.args or "users").split()
+    table = args[0]
+    fmt = args[1] if len(args) > 1 else "csv"
+    if table not in EXPORTS or fmt not in FORMATS:
+        await message.answer(f"Использование: /export [{'|'.join(EXPORTS)}] [{'|'.join(FORMATS)}]")
+        return
+    
+    await message.answer(f"⏳ Готовлю выгрузку {table}.{fmt}...")
+    # Строки пишутся в файл по мере получения - в памяти только текущая пачка
+    fd, path = tempfile.mkstemp(prefix=f"export-{table}-", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await export_to_file(table, fmt, marzban, path)
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            path = await asyncio.get_running_loop().run_in_executor(None, gzip_file, path)
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            await message.answer("❌ Выгрузка больше 50 МБ даже в gzip. Используйте /api/admin/export Web App.")
+            return
+        filename = f"{table}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}" + (".gz" if path.endswith(".gz") else "")
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"{table}: {count} строк")
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки {table}: {e}")
+        await message.answer(f"❌ Ошибка выгрузки: {e}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+@dp.message(Command("bulk_create"), F.from_user.id == TELEGRAM_ADMIN_ID)
+async def cmd_bulk_create(message: types.Message, command: CommandObject):
+    """Массовое создание ключей (только администратор)
+    
+    telegram_id - в тексте команды или в приложенном .txt/.csv с подписью /bulk_create.
+    """
+    text = command.args or ""
+    if message.document:
+        text += "\n" + (await bot.download(message.document)).read().decode("utf-8", errors="replace")
+    try:
+        telegram_ids = parse_telegram_ids(text)
+    except ValueError:
+        await message.answer("❌ Список должен содержать только telegram_id")
+        return
+    if not telegram_ids:
+        await message.answer("Использование: /bulk_create <telegram_id> ... или файл с подписью /bulk_create")
+        return
+    if len(telegram_ids) > BULK_MAX_USERS:
+        await message.answer(f"❌ Не больше {BULK_MAX_USERS} пользователей за раз")
+        return
+    
+    status_message = await message.answer(f"⏳ Создаю ключи: 0/{len(telegram_ids)}")
+    last_update = asyncio.get_running_loop().time()
+    
+    async def on_progress(done, total):
+        nonlocal last_update
+        # Не чаще раза в 3 секунды - лимит Telegram на редактирование
+        now = asyncio.get_running_loop().time()
+        if done < total and now - last_update < 3:
+            return
+        last_update = now
+        try:
+            await status_message.edit_text(f"⏳ Создаю ключи: {done}/{total}")
+        except Exception:
+            pass
+    
+    report = await provision_users(marzban, telegram_ids, on_progress=on_progress)
+    counts = summarize(report)
+    summary = ", ".join(f"{status}: {count}" for status, count in counts.items())
+    await message.answer_document(
+        BufferedInputFile(report_csv(report), filename=f"bulk-{datetime.now():%Y%m%d-%H%M%S}.csv"),
+        caption=f"✅ Готово ({len(report)}): {summary}"
+    )
+
 @dp.callback_query(F.data == "my_status")
 async def my_status_callback(callback: types.CallbackQuery):
     """Показать статус пользователя"""
@@ -148,7 +307,7 @@ async def my_status_callback(callback: types.CallbackQuery):
         return
     
     username = user["username"]
-    marzban_user = await marzban.get_user(username)
+    marzban_user = await marzban.get_user_status(username)
     
     if marzban_user:
         used_gb = marzban_user.get("used_traffic", 0) / (1024**3)
@@ -204,6 +363,12 @@ async def get_my_config_callback(callback: types.CallbackQuery):
             f"💡 Скопируйте и вставьте в ваш VPN клиент.",
             parse_mode="Markdown"
         )
+        png = await qr_cache.get_png(config)
+        if png:
+            await callback.message.answer_photo(
+                BufferedInputFile(png, filename="config.png"),
+                caption="📷 Или отсканируйте QR-код в VPN клиенте."
+            )
         await callback.answer("✅ Конфигурация отправлена")
     else:
         await callback.answer("❌ Не удалось получить конфигурацию", show_alert=True)
@@ -373,20 +538,145 @@ async def enable_free_mode_callback(callback: types.CallbackQuery):
             "Обратитесь к администратору."
         )
 
-async def main():
+async def on_startup():
+    """Общая инициализация процесса бота"""
     logging.info("Инициализация базы данных...")
     await init_db()  # Создаем таблицы users и transactions
     
-    # Инициализируем scheduler с ботом и Marzban API
-    set_bot_and_marzban(bot, marzban)
+    # Открываем пул соединений к Marzban API
+    await marzban.start()
+    
+    # Очередь уведомлений с лимитами Telegram
+    await notifier.start()
+    
+    # Инициализируем scheduler с ботом, Marzban API и диспетчером уведомлений
+    set_bot_and_marzban(bot, marzban, notifier)
+    
+    marzban.register_metrics()
+    notifier.register_metrics()
+    
+    # kill -USR1 <pid> - окно профилирования на PROFILE_SIGNAL_SECONDS
+    profiler.install_signal_handler()
+
+async def on_shutdown():
+    await notifier.stop()
+    await marzban.close()
+    await close_db()
+    qr_cache.close()
+
+async def run_polling():
+    """Один процесс: long polling и планировщик"""
+    await on_startup()
+    # Теплый старт трекера расхода: прошлые наблюдения из read-модели
+    await seed_usage_tracker()
     scheduler = start_scheduler()
+    backfills = asyncio.create_task(run_backfills())
+    
+    # /metrics процесса бота
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
     
     logging.info("Бот запущен...")
     try:
+        # getUpdates не работает, пока установлен webhook
+        await bot.delete_webhook()
         await dp.start_polling(bot)
     finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        backfills.cancel()
         scheduler.shutdown()
+        await on_shutdown()
 
-if __name__ == "__main__":
-    asyncio.run(main())
+async def _start_scheduler_when_elected(app: web.Application):
+    """Запустить планировщик, как только этот воркер станет лидером"""
+    await app["leader"].acquire()
+    logging.info(f"Воркер {os.getpid()} выбран лидером, запускаю планировщик")
+    await seed_usage_tracker()
+    app["scheduler"] = start_scheduler()
+    # Фоновые заполнения колонок - тоже только в одном воркере
+    await run_backfills()
+
+async def on_webhook_startup(app: web.Application):
+    await on_startup()
+    # Проверки лимитов и рассылка - только в одном воркере
+    app["leader"] = LeaderLock()
+    app["scheduler"] = None
+    app["leader_task"] = asyncio.create_task(_start_scheduler_when_elected(app))
+
+async def on_webhook_cleanup(app: web.Application):
+    app["leader_task"].cancel()
+    if app["scheduler"]:
+        app["scheduler"].shutdown()
+    app["leader"].release()
+    await on_shutdown()
 
+def create_webhook_app(secret_token: str) -> web.Application:
+    """aiohttp-приложение воркера: webhook Telegram и /metrics"""
+    app = web.Application()
+    # Апдейт обрабатывается в фоне, Telegram сразу получает 200;
+    # запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=secret_token
+    ).register(app, path=WEBHOOK_PATH)
+    # Порт webhook доступен извне - /metrics только с токеном
+    add_public_metrics_route(app)
+    app.on_startup.append(on_webhook_startup)
+    app.on_cleanup.append(on_webhook_cleanup)
+    return app
+
+def run_webhook_worker(secret_token: str, reuse_port: bool = False):
+    """Запустить один процесс webhook"""
+    web.run_app(
+        create_webhook_app(secret_token),
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        reuse_port=reuse_port,
+        access_log=None
+    )
+
+async def set_webhook(secret_token: str):
+    """Зарегистрировать webhook в Telegram (один раз, до запуска воркеров)"""
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=secret_token,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    # Воркеры создадут свои сессии в собственных event loop
+    await bot.session.close()
+    logging.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+def run_webhook():
+    """BOT_WORKERS процессов webhook на одном порту (SO_REUSEPORT)"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    asyncio.run(set_webhook(secret_token))
+    
+    if BOT_WORKERS <= 1:
+        run_webhook_worker(secret_token)
+        return
+    
+    workers = [
+        multiprocessing.Process(
+            target=run_webhook_worker,
+            kwargs={"secret_token": secret_token, "reuse_port": True},
+            name=f"bot-{i}"
+        )
+        for i in range(BOT_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def main():
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
+
+if __name__ == "__main__":
+    main()
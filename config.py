@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -12,9 +13,24 @@ MARZBAN_API_URL = os.getenv("MARZBAN_API_URL")
 MARZBAN_USERNAME = os.getenv("MARZBAN_USERNAME")
 MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD")
 
+# Несколько панелей Marzban: JSON-список [{"name": "de1", "url": "http://...", "username": "...", "password": "...", "weight": 1}]
+# username/password по умолчанию MARZBAN_USERNAME/MARZBAN_PASSWORD. Первая панель - основная:
+# на ней пользователи, созданные до появления шардирования. Без MARZBAN_NODES - одна панель MARZBAN_API_URL.
+MARZBAN_NODES = json.loads(os.getenv("MARZBAN_NODES") or "[]") or [{"name": "main", "url": MARZBAN_API_URL}]
+MARZBAN_PLACEMENT = os.getenv("MARZBAN_PLACEMENT", "hash")  # hash (consistent hashing) или least_load
+MARZBAN_PLACEMENT_CACHE_SIZE = int(os.getenv("MARZBAN_PLACEMENT_CACHE_SIZE", "100000"))  # username -> панель в памяти
+MARZBAN_NODE_COUNTS_TTL = float(os.getenv("MARZBAN_NODE_COUNTS_TTL", "60"))  # Как долго доверять числу пользователей на панелях
+
 # Server
 SERVER_IP = os.getenv("SERVER_IP")
 
+# QR-коды конфигураций
+QR_WORKERS = int(os.getenv("QR_WORKERS", "2"))  # Процессов рендера
+QR_BOX_SIZE = int(os.getenv("QR_BOX_SIZE", "8"))  # Пикселей на модуль QR-кода
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "qr_cache")  # Каталог кэша PNG (общий для воркеров)
+QR_MEMORY_CACHE_BYTES = int(os.getenv("QR_MEMORY_CACHE_BYTES", str(16 * 1024 * 1024)))  # Кэш PNG в памяти процесса
+QR_DISK_CACHE_BYTES = int(os.getenv("QR_DISK_CACHE_BYTES", str(256 * 1024 * 1024)))  # Кэш PNG на диске
+
 # Тарифы
 BASE_TARIFF_GB = 200  # Базовый тариф: 200 ГБ
 BASE_TARIFF_DAYS = 30  # Срок действия: 30 дней
@@ -25,3 +41,90 @@ EXTRA_GB_PRICE = 99  # Цена дополнительного пакета: 99
 
 FREE_MODE_SPEED_MBPS = 2  # Скорость бесплатного режима: 2 Мбит/с
 
+
+# Пул HTTP-соединений к Marzban API
+MARZBAN_POOL_LIMIT = int(os.getenv("MARZBAN_POOL_LIMIT", "100"))  # Всего соединений
+MARZBAN_POOL_LIMIT_PER_HOST = int(os.getenv("MARZBAN_POOL_LIMIT_PER_HOST", "20"))  # Соединений на хост
+MARZBAN_DNS_CACHE_TTL = int(os.getenv("MARZBAN_DNS_CACHE_TTL", "300"))  # Кэш DNS, сек
+MARZBAN_KEEPALIVE_TIMEOUT = float(os.getenv("MARZBAN_KEEPALIVE_TIMEOUT", "30"))  # Простой keep-alive соединения, сек
+MARZBAN_REQUEST_TIMEOUT = float(os.getenv("MARZBAN_REQUEST_TIMEOUT", "15"))  # Таймаут запроса, сек
+MARZBAN_CONNECT_TIMEOUT = float(os.getenv("MARZBAN_CONNECT_TIMEOUT", "5"))  # Таймаут установки соединения, сек
+MARZBAN_TOKEN_REFRESH_MARGIN = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", "60"))  # Обновлять токен за N сек до истечения
+MARZBAN_TOKEN_MIN_REFRESH_INTERVAL = float(os.getenv("MARZBAN_TOKEN_MIN_REFRESH_INTERVAL", "10"))  # Не чаще раза в N сек в фоне
+
+# Кэш пользователей Marzban (GET /api/user/{username})
+MARZBAN_USER_CACHE_TTL = float(os.getenv("MARZBAN_USER_CACHE_TTL", "30"))  # Время жизни записи, сек
+MARZBAN_USER_CACHE_SIZE = int(os.getenv("MARZBAN_USER_CACHE_SIZE", "10000"))  # Максимум записей
+MARZBAN_USER_CACHE_MAX_BYTES = int(os.getenv("MARZBAN_USER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))  # Примерный объем в памяти
+
+# SQLite
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # Постоянных соединений в пуле
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # Ожидание блокировки записи, мс
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # Кэш страниц на соединение, КБ
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # Размер mmap, байт
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # Подготовленных запросов на соединение
+DB_BACKFILL_BATCH_SIZE = int(os.getenv("DB_BACKFILL_BATCH_SIZE", "1000"))  # Строк за одну транзакцию фонового заполнения
+DB_BACKFILL_PAUSE_MS = float(os.getenv("DB_BACKFILL_PAUSE_MS", "50"))  # Пауза между пачками
+
+# Проверка лимитов
+LAST_CHECK_BATCH_SIZE = int(os.getenv("LAST_CHECK_BATCH_SIZE", "1000"))  # Сколько last_check записывать одной транзакцией
+LIMIT_RENOTIFY_HOURS = float(os.getenv("LIMIT_RENOTIFY_HOURS", "24"))  # Повторное уведомление о лимите не чаще, ч (0 - только при смене статуса)
+
+# Рассылка уведомлений
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))  # Воркеров отправки
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "100000"))  # Максимум сообщений в очереди
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))  # Попыток на одно сообщение
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # Сообщений в секунду на бота (лимит Telegram - 30)
+TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+MARZBAN_USERS_PAGE_SIZE = int(os.getenv("MARZBAN_USERS_PAGE_SIZE", "500"))  # Пользователей на страницу /api/users
+MARZBAN_USERS_PAGE_CONCURRENCY = int(os.getenv("MARZBAN_USERS_PAGE_CONCURRENCY", "4"))  # Параллельных запросов страниц
+LIMIT_SWEEP_INTERVAL_MINUTES = float(os.getenv("LIMIT_SWEEP_INTERVAL_MINUTES", "5"))  # Полный проход по всем пользователям
+HOT_CHECK_INTERVAL_SECONDS = float(os.getenv("HOT_CHECK_INTERVAL_SECONDS", "30"))  # Как часто искать пользователей у лимита
+HOT_CHECK_MIN_INTERVAL_SECONDS = float(os.getenv("HOT_CHECK_MIN_INTERVAL_SECONDS", "30"))  # Не чаще, чем раз в N сек на пользователя
+HOT_CHECK_SAFETY_FACTOR = float(os.getenv("HOT_CHECK_SAFETY_FACTOR", "0.5"))  # Проверять через эту долю прогноза до лимита
+HOT_CHECK_REMAINING_FRACTION = float(os.getenv("HOT_CHECK_REMAINING_FRACTION", "0.05"))  # Остаток, ниже которого расходующих трафик проверяем максимально часто
+HOT_CHECK_CONCURRENCY = int(os.getenv("HOT_CHECK_CONCURRENCY", "10"))  # Параллельных GET /api/user при внеочередной проверке
+HOT_CHECK_MAX_PER_RUN = int(os.getenv("HOT_CHECK_MAX_PER_RUN", "500"))  # Пользователей за один запуск
+
+# Web App API
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "5000"))
+WEBAPP_WORKERS = int(os.getenv("WEBAPP_WORKERS", "1"))  # Процессов на одном порту
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", str(LIMIT_SWEEP_INTERVAL_MINUTES * 60 + 60)))  # Статус из последнего прохода не старше N сек
+SNAPSHOT_PERSIST = os.getenv("SNAPSHOT_PERSIST", "1") == "1"  # Read-модель статусов в SQLite (0 - статусы всегда из Marzban)
+SNAPSHOT_PERSIST_MAX_AGE_HOURS = float(os.getenv("SNAPSHOT_PERSIST_MAX_AGE_HOURS", "24"))  # Более старые записи удаляются после прохода
+SNAPSHOT_SAVE_BATCH_SIZE = int(os.getenv("SNAPSHOT_SAVE_BATCH_SIZE", "1000"))  # Записей на одну транзакцию сохранения
+MARZBAN_WRITE_LOCK_TTL = float(os.getenv("MARZBAN_WRITE_LOCK_TTL", str(MARZBAN_REQUEST_TIMEOUT * 2 + 5)))  # Аренда записи пользователя между процессами, сек
+
+# Выгрузка пользователей и транзакций
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))  # Строк из БД за один запрос
+
+# Админские эндпоинты Web App (/api/admin/...)
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")  # Bearer-токен; если не задан, эндпоинты выключены
+
+# Массовое создание ключей
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))  # Параллельных созданий в Marzban
+BULK_DB_BATCH_SIZE = int(os.getenv("BULK_DB_BATCH_SIZE", "100"))  # Пользователей на одну транзакцию БД
+BULK_MAX_USERS = int(os.getenv("BULK_MAX_USERS", "5000"))  # Максимум telegram_id в одном запросе
+
+# Метрики Prometheus
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # /metrics процесса бота, 0 - не поднимать
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Если задан, /metrics требует заголовок Authorization: Bearer <токен>
+
+# Профилирование обработчиков
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # Доля апдейтов/запросов под профайлером, 0 - выключено
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # Период снятия стеков
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "profiles")  # Куда писать .folded
+PROFILE_SIGNAL_SECONDS = float(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))  # Длина окна по SIGUSR1
+
+# Режим работы бота
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.miravpn.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # X-Telegram-Bot-Api-Secret-Token; если не задан, генерируется при запуске
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # Процессов webhook на одном порту
+LEADER_LOCK_PATH = os.getenv("LEADER_LOCK_PATH", "scheduler.lock")  # Планировщик работает только в воркере, держащем этот lock
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "5"))  # Как часто остальные воркеры пытаются его забрать
@@ -1,51 +1,445 @@
 import aiosqlite
+import asyncio
 import logging
-from datetime import datetime
-from typing import Optional, Dict, List
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Iterable, AsyncIterator
+from config import (
+    DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_STATEMENT_CACHE_SIZE,
+    DB_BACKFILL_BATCH_SIZE, DB_BACKFILL_PAUSE_MS, EXPORT_BATCH_SIZE, SNAPSHOT_SAVE_BATCH_SIZE
+)
+from metrics import REGISTRY, timed
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = "vpn_bot.db"
 
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "db_query_duration_seconds", "Время выполнения функций database.py", ["function"]
+)
+DB_POOL_WAIT_SECONDS = REGISTRY.histogram(
+    "db_pool_wait_seconds", "Ожидание свободного соединения из пула"
+).labels()
+DB_ERRORS = REGISTRY.counter(
+    "db_errors_total", "Ошибки SQLite (locked - база занята дольше busy_timeout)", ["kind"]
+)
+
+class ConnectionPool:
+    """Пул постоянных соединений aiosqlite с WAL и настроенными PRAGMA"""
+    
+    def __init__(self, path: str = DB_PATH, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+    
+    async def open(self):
+        """Открыть соединения и один раз применить PRAGMA"""
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            db = aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE_SIZE)
+            # Поток соединения не должен мешать завершению процесса
+            db.daemon = True
+            await db
+            db.row_factory = aiosqlite.Row
+            await db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+            await db.execute("PRAGMA journal_mode = WAL")
+            await db.execute("PRAGMA synchronous = NORMAL")
+            await db.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+            await db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+            await db.execute("PRAGMA temp_store = MEMORY")
+            self._connections.append(db)
+            self._idle.put_nowait(db)
+        logger.info(f"Пул соединений SQLite открыт: {self.path} ({self.size} соединений, WAL)")
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """Взять соединение из пула; незавершенная транзакция откатывается при ошибке"""
+        started = time.perf_counter()
+        db = await self._idle.get()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+        try:
+            yield db
+        except BaseException:
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        finally:
+            self._idle.put_nowait(db)
+    
+    def idle_count(self) -> int:
+        return self._idle.qsize() if self._idle else 0
+    
+    async def close(self):
+        """Закрыть все соединения пула"""
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+        self._idle = None
+        logger.info("Пул соединений SQLite закрыт")
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock: Optional[asyncio.Lock] = None
+
+async def get_pool() -> ConnectionPool:
+    """Вернуть пул соединений, открыв его при первом обращении"""
+    global _pool, _pool_lock
+    if _pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool()
+                await pool.open()
+                _pool = pool
+    return _pool
+
+@asynccontextmanager
+async def connection():
+    """Соединение из общего пула"""
+    pool = await get_pool()
+    try:
+        async with pool.acquire() as db:
+            yield db
+    except aiosqlite.Error as e:
+        # Функции ниже перехватывают ошибки сами - считаем их здесь, пока они не проглочены
+        locked = isinstance(e, aiosqlite.OperationalError) and "locked" in str(e)
+        DB_ERRORS.labels("locked" if locked else type(e).__name__).inc()
+        raise
+
+REGISTRY.callback(
+    "db_pool_idle_connections", "Свободные соединения пула SQLite", (), "gauge",
+    lambda: [((), _pool.idle_count())] if _pool else []
+)
+
+async def close_db():
+    """Закрыть пул соединений (при остановке процесса)"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+async def _ensure_columns(db: aiosqlite.Connection, table: str, columns: Dict[str, str]):
+    """Добавить в таблицу недостающие колонки"""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {row["name"] for row in await cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+            logger.info(f"Добавлена колонка {table}.{name}")
+
+# Текущий тариф пользователя транзакции (миграция 6; выручка теперь считается по купленному тарифу)
+_TRANSACTION_TARIFF_SQL = (
+    "COALESCE((SELECT tariff_type FROM users WHERE users.telegram_id = transactions.telegram_id), 'unknown')"
+)
+
+# Купленный тариф по типу транзакции (докупка трафика продается к базовому тарифу)
+TRANSACTION_TARIFFS = {"base_tariff": "base", "extra_gb": "base"}
+
+# То же выражение для запросов к таблице transactions
+_TRANSACTION_TYPE_TARIFF_SQL = "CASE type {} ELSE 'unknown' END".format(
+    " ".join(f"WHEN '{kind}' THEN '{tariff}'" for kind, tariff in TRANSACTION_TARIFFS.items())
+)
+
+async def _migration_base_schema(db: aiosqlite.Connection):
+    """Таблицы первого релиза"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            tariff_type TEXT DEFAULT 'base',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_check TIMESTAMP,
+            free_mode_enabled BOOLEAN DEFAULT 0,
+            free_mode_until TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            type TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+        )
+    """)
+
+async def _migration_notification_state(db: aiosqlite.Connection):
+    """Состояние уведомлений о лимите"""
+    await _ensure_columns(db, "users", {
+        "notified_status": "TEXT",
+        "notified_at": "TIMESTAMP",
+        "notified_used_traffic": "INTEGER"
+    })
+
+async def _migration_user_node(db: aiosqlite.Connection):
+    """Панель Marzban пользователя; NULL - основная"""
+    await _ensure_columns(db, "users", {"node": "TEXT"})
+
+async def _migration_indexes(db: aiosqlite.Connection):
+    """Индексы под запросы database.py (см. QUERY_PLAN_CHECKS)"""
+    # get_user_transactions: WHERE telegram_id = ? ORDER BY timestamp DESC без сортировки
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (telegram_id, timestamp)"
+    )
+    # count_users_by_node: GROUP BY по индексу вместо сканирования таблицы
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_node ON users (node)")
+
+async def _migration_backfills(db: aiosqlite.Connection):
+    """Прогресс фоновых заполнений колонок (run_backfills)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS backfills (
+            name TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL,
+            done BOOLEAN NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP
+        )
+    """)
+
+async def _migration_revenue_rollup(db: aiosqlite.Connection):
+    """Тариф в транзакциях и дневные итоги выручки"""
+    await _ensure_columns(db, "transactions", {"tariff_type": "TEXT"})
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day TEXT NOT NULL,
+            type TEXT NOT NULL,
+            tariff_type TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, type, tariff_type)
+        ) WITHOUT ROWID
+    """)
+    # Итоги по уже накопленным транзакциям; дальше их ведет add_transaction.
+    # Тариф старых транзакций - текущий тариф пользователя (тот же, что запишет фоновое заполнение)
+    await db.execute("DELETE FROM revenue_daily")
+    await db.execute(f"""
+        INSERT INTO revenue_daily (day, type, tariff_type, amount, count)
+        SELECT date(timestamp), type, COALESCE(tariff_type, {_TRANSACTION_TARIFF_SQL}), SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY 1, 2, 3
+    """)
+
+async def _migration_user_snapshot(db: aiosqlite.Connection):
+    """Последние известные данные пользователей Marzban для теплого старта"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_snapshot (
+            username TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+
+async def _migration_user_snapshot_source(db: aiosqlite.Connection):
+    """Откуда запись read-модели: 1 - полный проход планировщика, 0 - запрос одного пользователя"""
+    await _ensure_columns(db, "user_snapshot", {"swept": "INTEGER NOT NULL DEFAULT 0"})
+
+async def _migration_user_write_locks(db: aiosqlite.Connection):
+    """Аренды записи пользователей Marzban: изменения одного пользователя из бота и Web App по очереди"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_write_locks (
+            username TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+async def _migration_export_seen(db: aiosqlite.Connection):
+    """Пользователи Marzban, уже попавшие в выгрузку: ищем пользователей только из БД без множества в памяти"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS export_seen (
+            export_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            PRIMARY KEY (export_id, username)
+        ) WITHOUT ROWID
+    """)
+
+async def _migration_revenue_by_purchased_tariff(db: aiosqlite.Connection):
+    """Дневные итоги выручки по купленному тарифу, а не по текущему тарифу пользователя"""
+    # Колонку transactions.tariff_type пересчитывает фоновое заполнение, итоги считаются сразу по типу
+    await db.execute("DELETE FROM revenue_daily")
+    await db.execute(f"""
+        INSERT INTO revenue_daily (day, type, tariff_type, amount, count)
+        SELECT date(timestamp), type, {_TRANSACTION_TYPE_TARIFF_SQL}, SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY 1, 2, 3
+    """)
+
+# (версия, описание, функция). Версия схемы хранится в PRAGMA user_version.
+# Миграции только добавляются в конец; уже выпущенные не меняются.
+# Базы, созданные до появления миграций, имеют версию 0: первые миграции идемпотентны.
+MIGRATIONS = [
+    (1, "Таблицы users и transactions", _migration_base_schema),
+    (2, "Состояние уведомлений о лимите", _migration_notification_state),
+    (3, "Панель Marzban пользователя", _migration_user_node),
+    (4, "Индексы под запросы", _migration_indexes),
+    (5, "Таблица прогресса фоновых заполнений", _migration_backfills),
+    (6, "Дневные итоги выручки", _migration_revenue_rollup),
+    (7, "Сохраненная read-модель пользователей Marzban", _migration_user_snapshot),
+    (8, "Источник записей read-модели", _migration_user_snapshot_source),
+    (9, "Аренды записи пользователей Marzban", _migration_user_write_locks),
+    (10, "Отметки пользователей в выгрузке", _migration_export_seen),
+    (11, "Выручка по купленному тарифу", _migration_revenue_by_purchased_tariff),
+]
+
+async def _schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Применить недостающие миграции; вернуть итоговую версию схемы
+    
+    Каждая миграция - отдельная транзакция BEGIN IMMEDIATE: параллельно стартующие
+    процессы не применят одну миграцию дважды.
+    """
+    for version, description, migration in MIGRATIONS:
+        if await _schema_version(db) >= version:
+            continue
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            # Версию перечитываем под блокировкой записи - другой процесс мог успеть раньше
+            if await _schema_version(db) >= version:
+                await db.rollback()
+                continue
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        logger.info(f"Миграция {version} применена: {description}")
+    return await _schema_version(db)
+
+# Запросы database.py и индексы, которые они должны использовать
+QUERY_PLAN_CHECKS = [
+    (
+        "SELECT * FROM transactions WHERE telegram_id = ? ORDER BY timestamp DESC LIMIT ?",
+        (1, 10),
+        "idx_transactions_user_time"
+    ),
+    ("SELECT * FROM users WHERE telegram_id = ?", (1,), "INTEGER PRIMARY KEY"),
+    ("SELECT * FROM users WHERE username = ?", ("user",), "sqlite_autoindex_users_1"),
+    ("SELECT * FROM users WHERE username IN (?, ?)", ("a", "b"), "sqlite_autoindex_users_1"),
+    ("SELECT node, COUNT(*) FROM users GROUP BY node", (), "idx_users_node"),
+    ("SELECT * FROM revenue_daily WHERE day >= ?", ("2024-01-01",), "PRIMARY KEY"),
+    ("SELECT * FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?", (0, 1000), "INTEGER PRIMARY KEY"),
+    (
+        "SELECT 1 FROM export_seen WHERE export_id = ? AND username = ?",
+        ("export", "user"),
+        "PRIMARY KEY (export_id=? AND username=?)"
+    ),
+    ("SELECT fetched_at, data, swept FROM user_snapshot WHERE username = ?", ("user",), "sqlite_autoindex_user_snapshot_1"),
+    (
+        "SELECT username, fetched_at, data, swept FROM user_snapshot WHERE username > ? ORDER BY username LIMIT ?",
+        ("", 1000),
+        "sqlite_autoindex_user_snapshot_1"
+    ),
+    (
+        "SELECT transactions.*, users.username FROM transactions LEFT JOIN users USING (telegram_id) "
+        "WHERE transactions.id > ? ORDER BY transactions.id LIMIT ?",
+        (0, 1000),
+        "INTEGER PRIMARY KEY"
+    ),
+]
+
+async def check_query_plans(db: aiosqlite.Connection) -> List[str]:
+    """Проверить по EXPLAIN QUERY PLAN, что запросы идут по индексам, без полного сканирования и сортировки
+    
+    Возвращает описания запросов с неожиданным планом. Текст плана зависит от версии SQLite,
+    поэтому при старте расхождения только логируются, а проваливают их бенчмарки.
+    """
+    # EXPLAIN не сверяет версию схемы: обычный запрос заставляет соединение перечитать
+    # схему, если индексы только что создал другой процесс или другое соединение пула
+    async with db.execute("SELECT COUNT(*) FROM sqlite_master"):
+        pass
+    problems = []
+    for sql, params, expected in QUERY_PLAN_CHECKS:
+        async with db.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+            plan = " | ".join(row[3] for row in await cursor.fetchall())
+        if expected not in plan or "USE TEMP B-TREE" in plan:
+            problems.append(f"{sql}: {plan}")
+    return problems
+
+@timed(DB_QUERY_SECONDS)
 async def init_db():
-    """Инициализация базы данных и создание таблиц"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Таблица пользователей
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id INTEGER PRIMARY KEY,
-                username TEXT NOT NULL UNIQUE,
-                tariff_type TEXT DEFAULT 'base',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_check TIMESTAMP,
-                free_mode_enabled BOOLEAN DEFAULT 0,
-                free_mode_until TIMESTAMP
-            )
-        """)
-        
-        # Таблица транзакций
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                type TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-            )
-        """)
-        
-        await db.commit()
-        logger.info("База данных инициализирована")
+    """Инициализация базы данных: миграции схемы и проверка планов запросов"""
+    async with connection() as db:
+        version = await migrate(db)
+        problems = await check_query_plans(db)
+        if problems:
+            logger.warning("Неожиданные планы запросов (нет индекса или лишняя сортировка):\n" + "\n".join(problems))
+        logger.info(f"База данных инициализирована (версия схемы {version})")
+
+async def run_backfill(name: str, table: str, assignments: str, condition: str = "1",
+                       batch_size: int = DB_BACKFILL_BATCH_SIZE, pause: float = DB_BACKFILL_PAUSE_MS / 1000):
+    """Заполнить колонки уже существующих строк пачками, не останавливая работу бота
+    
+    UPDATE {table} SET {assignments} WHERE {condition} выполняется по диапазонам rowid
+    короткими транзакциями с паузой между ними, так что остальные запросы не ждут
+    всю операцию. Прогресс сохраняется в таблице backfills: после перезапуска
+    заполнение продолжается с места остановки. Новые строки должны заполняться
+    кодом записи, поэтому граница берется на момент старта.
+    """
+    async with connection() as db:
+        async with db.execute("SELECT last_rowid, done FROM backfills WHERE name = ?", (name,)) as cursor:
+            row = await cursor.fetchone()
+        if row and row["done"]:
+            return
+        async with db.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}") as cursor:
+            min_rowid, max_rowid = await cursor.fetchone()
+        if max_rowid is None:
+            min_rowid = max_rowid = 0
+        # rowid может быть нулевым и отрицательным (telegram_id - INTEGER PRIMARY KEY)
+        last_rowid = row["last_rowid"] if row else min_rowid - 1
+    
+    logger.info(f"Фоновое заполнение {name}: строки {last_rowid + 1}..{max_rowid}")
+    while True:
+        upper = min(last_rowid + batch_size, max_rowid)
+        async with connection() as db:
+            if last_rowid < max_rowid:
+                await db.execute(
+                    f"UPDATE {table} SET {assignments} WHERE rowid > ? AND rowid <= ? AND ({condition})",
+                    (last_rowid, upper)
+                )
+            done = upper >= max_rowid
+            await db.execute("""
+                INSERT INTO backfills (name, last_rowid, done, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    last_rowid = excluded.last_rowid, done = excluded.done, updated_at = excluded.updated_at
+            """, (name, upper, done, datetime.now()))
+            await db.commit()
+        last_rowid = upper
+        if done:
+            logger.info(f"Фоновое заполнение {name} завершено")
+            return
+        await asyncio.sleep(pause)
+
+# Фоновые заполнения: (имя, таблица, SET-выражение, условие WHERE)
+BACKFILLS = [
+    ("transactions.tariff_type_by_type", "transactions", f"tariff_type = {_TRANSACTION_TYPE_TARIFF_SQL}",
+     f"tariff_type IS NOT {_TRANSACTION_TYPE_TARIFF_SQL}"),
+]
 
-async def create_user(telegram_id: int, username: str, tariff_type: str = "base") -> bool:
-    """Создание нового пользователя в базе данных"""
+async def run_backfills():
+    """Выполнить незавершенные фоновые заполнения по очереди"""
+    for name, table, assignments, condition in BACKFILLS:
+        try:
+            await run_backfill(name, table, assignments, condition)
+        except Exception as e:
+            logger.error(f"Ошибка фонового заполнения {name}: {e}")
+
+@timed(DB_QUERY_SECONDS)
+async def create_user(telegram_id: int, username: str, tariff_type: str = "base",
+                      node: Optional[str] = None) -> bool:
+    """Создание нового пользователя в базе данных (node - панель Marzban, на которой он создан)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
             await db.execute("""
-                INSERT INTO users (telegram_id, username, tariff_type, created_at)
-                VALUES (?, ?, ?, ?)
-            """, (telegram_id, username, tariff_type, datetime.now()))
+                INSERT INTO users (telegram_id, username, tariff_type, created_at, node)
+                VALUES (?, ?, ?, ?, ?)
+            """, (telegram_id, username, tariff_type, datetime.now(), node))
             await db.commit()
             logger.info(f"Пользователь создан: {telegram_id} -> {username}")
             return True
@@ -56,11 +450,64 @@ async def create_user(telegram_id: int, username: str, tariff_type: str = "base"
         logger.error(f"Ошибка при создании пользователя: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
+async def create_users_bulk(users: Iterable[tuple], transaction: Optional[tuple] = None) -> set:
+    """Создать пользователей (telegram_id, username, tariff_type, node) одной транзакцией
+    
+    Уже существующие (по telegram_id или username, например созданные параллельным /start)
+    пропускаются. transaction - (сумма, тип): каждому добавленному пользователю в той же
+    транзакции записывается покупка, как в add_transaction. Возвращает множество telegram_id
+    добавленных строк; при ошибке БД исключение пробрасывается - вызывающий решает, что
+    делать с пачкой.
+    """
+    now = datetime.now()
+    rows = [(telegram_id, username, tariff_type, now, node) for telegram_id, username, tariff_type, node in users]
+    if not rows:
+        return set()
+    async with connection() as db:
+        # Блокировка записи до проверки: между SELECT и INSERT никто не добавит тех же пользователей
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            placeholders = ",".join("?" * len(rows))
+            async with db.execute(
+                f"SELECT telegram_id, username FROM users "
+                f"WHERE telegram_id IN ({placeholders}) OR username IN ({placeholders})",
+                [row[0] for row in rows] + [row[1] for row in rows]
+            ) as cursor:
+                existing = await cursor.fetchall()
+            existing_ids = {row[0] for row in existing}
+            existing_names = {row[1] for row in existing}
+            rows = [row for row in rows if row[0] not in existing_ids and row[1] not in existing_names]
+            await db.executemany("""
+                INSERT INTO users (telegram_id, username, tariff_type, created_at, node)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            """, rows)
+            if transaction and rows:
+                amount, transaction_type = transaction
+                tariff_type = TRANSACTION_TARIFFS.get(transaction_type, "unknown")
+                await db.executemany("""
+                    INSERT INTO transactions (telegram_id, amount, type, timestamp, tariff_type)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [(row[0], amount, transaction_type, now, tariff_type) for row in rows])
+                await db.execute("""
+                    INSERT INTO revenue_daily (day, type, tariff_type, amount, count)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(day, type, tariff_type) DO UPDATE SET
+                        amount = amount + excluded.amount, count = count + excluded.count
+                """, (now.date().isoformat(), transaction_type, tariff_type, amount * len(rows), len(rows)))
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+    logger.info(f"Пользователей создано пачкой: {len(rows)}, уже были: {len(existing)}")
+    return {row[0] for row in rows}
+
+@timed(DB_QUERY_SECONDS)
 async def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict]:
     """Получить пользователя по Telegram ID"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with connection() as db:
             async with db.execute("""
                 SELECT * FROM users WHERE telegram_id = ?
             """, (telegram_id,)) as cursor:
@@ -72,11 +519,11 @@ async def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict]:
         logger.error(f"Ошибка при получении пользователя: {e}")
         return None
 
+@timed(DB_QUERY_SECONDS)
 async def get_user_by_username(username: str) -> Optional[Dict]:
     """Получить пользователя по username"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with connection() as db:
             async with db.execute("""
                 SELECT * FROM users WHERE username = ?
             """, (username,)) as cursor:
@@ -88,10 +535,34 @@ async def get_user_by_username(username: str) -> Optional[Dict]:
         logger.error(f"Ошибка при получении пользователя: {e}")
         return None
 
+@timed(DB_QUERY_SECONDS)
+async def get_user_node(username: str) -> Optional[str]:
+    """Панель Marzban пользователя (None - основная или пользователя нет)"""
+    try:
+        async with connection() as db:
+            async with db.execute("SELECT node FROM users WHERE username = ?", (username,)) as cursor:
+                row = await cursor.fetchone()
+                return row["node"] if row else None
+    except Exception as e:
+        logger.error(f"Ошибка при получении панели пользователя: {e}")
+        return None
+
+@timed(DB_QUERY_SECONDS)
+async def count_users_by_node() -> Dict[Optional[str], int]:
+    """Количество пользователей по панелям Marzban (ключ None - основная)"""
+    try:
+        async with connection() as db:
+            async with db.execute("SELECT node, COUNT(*) FROM users GROUP BY node") as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете пользователей по панелям: {e}")
+        return {}
+
+@timed(DB_QUERY_SECONDS)
 async def update_user_tariff(telegram_id: int, tariff_type: str) -> bool:
     """Обновить тип тарифа пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
             await db.execute("""
                 UPDATE users SET tariff_type = ? WHERE telegram_id = ?
             """, (tariff_type, telegram_id))
@@ -102,10 +573,11 @@ async def update_user_tariff(telegram_id: int, tariff_type: str) -> bool:
         logger.error(f"Ошибка при обновлении тарифа: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
 async def update_last_check(telegram_id: int) -> bool:
     """Обновить время последней проверки"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
             await db.execute("""
                 UPDATE users SET last_check = ? WHERE telegram_id = ?
             """, (datetime.now(), telegram_id))
@@ -115,10 +587,51 @@ async def update_last_check(telegram_id: int) -> bool:
         logger.error(f"Ошибка при обновлении last_check: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
+async def update_last_check_bulk(telegram_ids: Iterable[int]) -> bool:
+    """Обновить время последней проверки для набора пользователей одной транзакцией"""
+    now = datetime.now()
+    params = [(now, telegram_id) for telegram_id in telegram_ids]
+    if not params:
+        return True
+    try:
+        async with connection() as db:
+            await db.executemany("""
+                UPDATE users SET last_check = ? WHERE telegram_id = ?
+            """, params)
+            await db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном обновлении last_check: {e}")
+        return False
+
+@timed(DB_QUERY_SECONDS)
+async def update_notification_state_bulk(states: Iterable[tuple]) -> bool:
+    """Сохранить состояние уведомлений о лимите одной транзакцией
+    
+    states - кортежи (telegram_id, notified_status, notified_at, notified_used_traffic)
+    """
+    params = [(status, notified_at, used, telegram_id) for telegram_id, status, notified_at, used in states]
+    if not params:
+        return True
+    try:
+        async with connection() as db:
+            await db.executemany("""
+                UPDATE users
+                SET notified_status = ?, notified_at = ?, notified_used_traffic = ?
+                WHERE telegram_id = ?
+            """, params)
+            await db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния уведомлений: {e}")
+        return False
+
+@timed(DB_QUERY_SECONDS)
 async def enable_free_mode(telegram_id: int, until_timestamp: datetime) -> bool:
     """Включить бесплатный режим для пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
             await db.execute("""
                 UPDATE users 
                 SET free_mode_enabled = 1, free_mode_until = ?
@@ -131,10 +644,11 @@ async def enable_free_mode(telegram_id: int, until_timestamp: datetime) -> bool:
         logger.error(f"Ошибка при включении бесплатного режима: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
 async def disable_free_mode(telegram_id: int) -> bool:
     """Отключить бесплатный режим для пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
             await db.execute("""
                 UPDATE users 
                 SET free_mode_enabled = 0, free_mode_until = NULL
@@ -147,11 +661,11 @@ async def disable_free_mode(telegram_id: int) -> bool:
         logger.error(f"Ошибка при отключении бесплатного режима: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
 async def get_all_users() -> List[Dict]:
     """Получить всех пользователей для проверки лимитов"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with connection() as db:
             async with db.execute("SELECT * FROM users") as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
@@ -159,14 +673,160 @@ async def get_all_users() -> List[Dict]:
         logger.error(f"Ошибка при получении всех пользователей: {e}")
         return []
 
+@timed(DB_QUERY_SECONDS)
+async def get_users_by_usernames(usernames: Iterable[str]) -> Dict[str, Dict]:
+    """Получить пользователей по списку username (username -> запись)"""
+    usernames = list(usernames)
+    result = {}
+    try:
+        async with connection() as db:
+            # Не упираемся в лимит параметров SQLite
+            for i in range(0, len(usernames), 500):
+                chunk = usernames[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                async with db.execute(
+                    f"SELECT * FROM users WHERE username IN ({placeholders})", chunk
+                ) as cursor:
+                    async for row in cursor:
+                        result[row["username"]] = dict(row)
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователей по username: {e}")
+        return result
+
+@timed(DB_QUERY_SECONDS)
+async def get_users_by_telegram_ids(telegram_ids: Iterable[int]) -> Dict[int, Dict]:
+    """Получить пользователей по списку telegram_id (telegram_id -> запись)"""
+    telegram_ids = list(telegram_ids)
+    result = {}
+    try:
+        async with connection() as db:
+            for i in range(0, len(telegram_ids), 500):
+                chunk = telegram_ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                async with db.execute(
+                    f"SELECT * FROM users WHERE telegram_id IN ({placeholders})", chunk
+                ) as cursor:
+                    async for row in cursor:
+                        result[row["telegram_id"]] = dict(row)
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователей по telegram_id: {e}")
+        return result
+
+@timed(DB_QUERY_SECONDS)
+async def count_users() -> int:
+    """Количество пользователей в базе"""
+    try:
+        async with connection() as db:
+            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+                row = await cursor.fetchone()
+                return row[0]
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете пользователей: {e}")
+        return 0
+
+async def iter_users_batches(batch_size: int = EXPORT_BATCH_SIZE,
+                             unseen_in_export: Optional[str] = None) -> AsyncIterator[List[Dict]]:
+    """Всех пользователей пачками по batch_size (async-генератор списков, по возрастанию telegram_id)
+    
+    Каждая пачка - отдельный запрос по ключу (telegram_id > последнего выданного), соединение
+    возвращается в пул до передачи пачки вызывающему. Ошибки БД не перехватываются:
+    выгрузка не должна молча обрываться на середине.
+    unseen_in_export - только пользователи, не отмеченные в этой выгрузке (mark_export_seen).
+    Пачка может оказаться пустой, если все ее пользователи отмечены.
+    """
+    last_id = None
+    while True:
+        async with connection() as db:
+            if last_id is None:
+                cursor = await db.execute("SELECT * FROM users ORDER BY telegram_id LIMIT ?", (batch_size,))
+            else:
+                cursor = await db.execute(
+                    "SELECT * FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?", (last_id, batch_size)
+                )
+            async with cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+            if not rows:
+                return
+            last_id = rows[-1]["telegram_id"]
+            last_batch = len(rows) < batch_size
+            if unseen_in_export is not None:
+                placeholders = ",".join("?" * len(rows))
+                async with db.execute(
+                    f"SELECT username FROM export_seen WHERE export_id = ? AND username IN ({placeholders})",
+                    [unseen_in_export] + [row["username"] for row in rows]
+                ) as cursor:
+                    seen = {row[0] for row in await cursor.fetchall()}
+                rows = [row for row in rows if row["username"] not in seen]
+        yield rows
+        if last_batch:
+            return
+
+@timed(DB_QUERY_SECONDS)
+async def mark_export_seen(export_id: str, usernames: Iterable[str], started_at: float):
+    """Отметить пользователей Marzban, уже попавших в выгрузку export_id"""
+    async with connection() as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO export_seen (export_id, username, started_at) VALUES (?, ?, ?)",
+            [(export_id, username, started_at) for username in usernames]
+        )
+        await db.commit()
+
+@timed(DB_QUERY_SECONDS)
+async def clear_export_seen(export_id: str, older_than: Optional[float] = None) -> bool:
+    """Удалить отметки выгрузки export_id и брошенных выгрузок, начатых раньше older_than"""
+    try:
+        async with connection() as db:
+            await db.execute("DELETE FROM export_seen WHERE export_id = ?", (export_id,))
+            if older_than is not None:
+                await db.execute("DELETE FROM export_seen WHERE started_at < ?", (older_than,))
+            await db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Ошибка при очистке отметок выгрузки: {e}")
+        return False
+
+async def iter_transactions_batches(batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[List[Dict]]:
+    """Все транзакции с username пользователя пачками по batch_size (по возрастанию id)"""
+    last_id = 0
+    while True:
+        async with connection() as db:
+            async with db.execute("""
+                SELECT transactions.*, users.username
+                FROM transactions LEFT JOIN users USING (telegram_id)
+                WHERE transactions.id > ?
+                ORDER BY transactions.id
+                LIMIT ?
+            """, (last_id, batch_size)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+        if not rows:
+            return
+        last_id = rows[-1]["id"]
+        yield rows
+        if len(rows) < batch_size:
+            return
+
+@timed(DB_QUERY_SECONDS)
 async def add_transaction(telegram_id: int, amount: float, transaction_type: str) -> bool:
-    """Добавить транзакцию"""
+    """Добавить транзакцию и учесть ее в дневных итогах (одной транзакцией БД)
+    
+    Тариф берется из типа транзакции: смена тарифа пользователем не переносит прошлую выручку.
+    """
+    now = datetime.now()
+    tariff_type = TRANSACTION_TARIFFS.get(transaction_type, "unknown")
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with connection() as db:
+            await db.execute("""
+                INSERT INTO transactions (telegram_id, amount, type, timestamp, tariff_type)
+                VALUES (?, ?, ?, ?, ?)
+            """, (telegram_id, amount, transaction_type, now, tariff_type))
             await db.execute("""
-                INSERT INTO transactions (telegram_id, amount, type, timestamp)
-                VALUES (?, ?, ?, ?)
-            """, (telegram_id, amount, transaction_type, datetime.now()))
+                INSERT INTO revenue_daily (day, type, tariff_type, amount, count)
+                VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT(day, type, tariff_type) DO UPDATE SET
+                    amount = amount + excluded.amount, count = count + 1
+            """, (now.date().isoformat(), transaction_type, tariff_type, amount))
             await db.commit()
             logger.info(f"Транзакция добавлена: {telegram_id} - {amount}₽ ({transaction_type})")
             return True
@@ -174,11 +834,11 @@ async def add_transaction(telegram_id: int, amount: float, transaction_type: str
         logger.error(f"Ошибка при добавлении транзакции: {e}")
         return False
 
+@timed(DB_QUERY_SECONDS)
 async def get_user_transactions(telegram_id: int, limit: int = 10) -> List[Dict]:
     """Получить транзакции пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with connection() as db:
             async with db.execute("""
                 SELECT * FROM transactions 
                 WHERE telegram_id = ? 
@@ -191,3 +851,150 @@ async def get_user_transactions(telegram_id: int, limit: int = 10) -> List[Dict]
         logger.error(f"Ошибка при получении транзакций: {e}")
         return []
 
+@timed(DB_QUERY_SECONDS)
+async def get_revenue_by_day(days: int = 30) -> List[Dict]:
+    """Выручка и число транзакций по дням за последние days дней (из дневных итогов)"""
+    since = (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+    try:
+        async with connection() as db:
+            async with db.execute("""
+                SELECT day, SUM(amount) AS amount, SUM(count) AS count
+                FROM revenue_daily
+                WHERE day >= ?
+                GROUP BY day
+                ORDER BY day
+            """, (since,)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка при получении выручки по дням: {e}")
+        return []
+
+@timed(DB_QUERY_SECONDS)
+async def get_revenue_summary(days: int = 30) -> Dict:
+    """Итоги выручки за последние days дней: всего, по типу транзакции и по тарифу
+    
+    Читаются только дневные итоги (дни x типы x тарифы), размер таблицы транзакций не важен.
+    """
+    since = (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+    summary = {"since": since, "amount": 0.0, "count": 0, "by_type": {}, "by_tariff": {}}
+    try:
+        async with connection() as db:
+            async with db.execute("""
+                SELECT type, tariff_type, SUM(amount) AS amount, SUM(count) AS count
+                FROM revenue_daily
+                WHERE day >= ?
+                GROUP BY type, tariff_type
+            """, (since,)) as cursor:
+                async for row in cursor:
+                    summary["amount"] += row["amount"]
+                    summary["count"] += row["count"]
+                    for key, group in (("by_type", row["type"]), ("by_tariff", row["tariff_type"])):
+                        totals = summary[key].setdefault(group, {"amount": 0.0, "count": 0})
+                        totals["amount"] += row["amount"]
+                        totals["count"] += row["count"]
+        return summary
+    except Exception as e:
+        logger.error(f"Ошибка при получении итогов выручки: {e}")
+        return summary
+
+@timed(DB_QUERY_SECONDS)
+async def save_user_snapshot(entries: Iterable[tuple], deleted: Iterable[str] = (),
+                             batch_size: int = SNAPSHOT_SAVE_BATCH_SIZE) -> int:
+    """Сохранить записи read-модели (username, fetched_at, data JSON, swept) пачками коротких транзакций
+    
+    Запись заменяется, только если она свежее сохраненной: страница прохода, запрошенная
+    до покупки в другом процессе, не затирает ее результат. deleted - username, которых
+    больше нет в Marzban или чье состояние неизвестно.
+    """
+    entries = list(entries)
+    saved = 0
+    for i in range(0, len(entries), batch_size):
+        async with connection() as db:
+            async with db.executemany("""
+                INSERT INTO user_snapshot (username, fetched_at, data, swept) VALUES (?, ?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET
+                    fetched_at = excluded.fetched_at, data = excluded.data, swept = excluded.swept
+                WHERE excluded.fetched_at > user_snapshot.fetched_at
+            """, entries[i:i + batch_size]) as cursor:
+                saved += cursor.rowcount
+            await db.commit()
+        # Пауза между пачками - остальные записи в БД не ждут все сохранение
+        await asyncio.sleep(0)
+    deleted = list(deleted)
+    if deleted:
+        async with connection() as db:
+            await db.executemany("DELETE FROM user_snapshot WHERE username = ?", [(username,) for username in deleted])
+            await db.commit()
+    return saved
+
+@timed(DB_QUERY_SECONDS)
+async def get_user_snapshot(username: str) -> Optional[tuple]:
+    """Запись read-модели (fetched_at, data JSON, swept) или None"""
+    async with connection() as db:
+        async with db.execute(
+            "SELECT fetched_at, data, swept FROM user_snapshot WHERE username = ?", (username,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return tuple(row) if row else None
+
+@timed(DB_QUERY_SECONDS)
+async def prune_user_snapshot(older_than: float) -> int:
+    """Удалить записи read-модели, полученные раньше older_than (unix time)"""
+    async with connection() as db:
+        async with db.execute("DELETE FROM user_snapshot WHERE fetched_at < ?", (older_than,)) as cursor:
+            deleted = cursor.rowcount
+        await db.commit()
+    return deleted
+
+async def iter_user_snapshot_batches(since: float = 0,
+                                     batch_size: int = SNAPSHOT_SAVE_BATCH_SIZE) -> AsyncIterator[List[tuple]]:
+    """Сохраненные записи read-модели не старше since пачками (username, fetched_at, data JSON, swept)"""
+    last_username = ""
+    while True:
+        async with connection() as db:
+            async with db.execute(
+                "SELECT username, fetched_at, data, swept FROM user_snapshot WHERE username > ? ORDER BY username LIMIT ?",
+                (last_username, batch_size)
+            ) as cursor:
+                rows = [tuple(row) for row in await cursor.fetchall()]
+        if not rows:
+            return
+        last_username = rows[-1][0]
+        fresh = [row for row in rows if row[1] >= since]
+        if fresh:
+            yield fresh
+        if len(rows) < batch_size:
+            return
+
+@timed(DB_QUERY_SECONDS)
+async def acquire_user_write_lock(username: str, owner: str, ttl: float) -> bool:
+    """Взять аренду записи пользователя на ttl секунд; False - ее держит другой владелец
+
+    Истекшая аренда (владелец упал, не освободив ее) забирается.
+    """
+    now = time.time()
+    try:
+        async with connection() as db:
+            async with db.execute("""
+                INSERT INTO user_write_locks (username, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE user_write_locks.expires_at < ?
+            """, (username, owner, now + ttl, now)) as cursor:
+                acquired = cursor.rowcount == 1
+            await db.commit()
+            return acquired
+    except Exception as e:
+        logger.error(f"Ошибка при получении аренды записи {username}: {e}")
+        return False
+
+@timed(DB_QUERY_SECONDS)
+async def release_user_write_lock(username: str, owner: str) -> bool:
+    """Освободить аренду записи пользователя, если она все еще принадлежит owner"""
+    try:
+        async with connection() as db:
+            await db.execute("DELETE FROM user_write_locks WHERE username = ? AND owner = ?", (username, owner))
+            await db.commit()
+            return True
+    except Exception as e:
+        logger.error(f"Ошибка при освобождении аренды записи {username}: {e}")
+        return False
@@ -0,0 +1,131 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Sequence, Tuple
+from database import (
+    iter_users_batches, iter_transactions_batches, get_users_by_usernames, mark_export_seen, clear_export_seen
+)
+
+logger = logging.getLogger(__name__)
+
+# Отметки выгрузки старше этого считаются брошенными
+EXPORT_SEEN_MAX_AGE_SECONDS = 24 * 3600
+
+# Колонки выгрузок: поля БД, затем данные Marzban
+USER_DB_FIELDS = (
+    "telegram_id", "username", "tariff_type", "node", "created_at", "last_check",
+    "free_mode_enabled", "free_mode_until"
+)
+USER_MARZBAN_FIELDS = ("status", "used_traffic", "lifetime_used_traffic", "data_limit", "expire")
+USER_FIELDS = USER_DB_FIELDS + USER_MARZBAN_FIELDS + ("source",)
+TRANSACTION_FIELDS = ("id", "telegram_id", "username", "amount", "type", "tariff_type", "timestamp")
+
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson"
+}
+
+def _user_row(db_user, marzban_user, source) -> Dict:
+    row = {field: (db_user or {}).get(field) for field in USER_DB_FIELDS}
+    if marzban_user:
+        row["username"] = marzban_user.get("username")
+        for field in USER_MARZBAN_FIELDS:
+            row[field] = marzban_user.get(field)
+    else:
+        row.update(dict.fromkeys(USER_MARZBAN_FIELDS))
+    row["source"] = source
+    return row
+
+async def iter_user_rows(marzban) -> AsyncIterator[List[Dict]]:
+    """Пользователи с данными Marzban пачками (в памяти одна страница)
+
+    Сначала постранично обходятся пользователи панелей, каждая страница дополняется
+    записями БД одним запросом (как в check_limits_task), а пользователи страницы
+    отмечаются в таблице export_seen. Затем по БД выбираются неотмеченные - те,
+    кого в панелях не нашлось. Колонка source: both, marzban (создан не ботом) или db.
+    """
+    started = time.time()
+    export_id = uuid.uuid4().hex
+    try:
+        async for page in marzban.iter_users_pages():
+            usernames = [user.get("username") for user in page]
+            db_users = await get_users_by_usernames(usernames)
+            await mark_export_seen(export_id, (username for username in usernames if username in db_users), started)
+            yield [
+                _user_row(db_users.get(user.get("username")), user, "both" if user.get("username") in db_users else "marzban")
+                for user in page
+            ]
+
+        async for batch in iter_users_batches(unseen_in_export=export_id):
+            if batch:
+                yield [_user_row(db_user, None, "db") for db_user in batch]
+    finally:
+        # Заодно удаляются отметки выгрузок, оборванных вместе с процессом
+        await clear_export_seen(export_id, older_than=started - EXPORT_SEEN_MAX_AGE_SECONDS)
+
+async def iter_transaction_rows(marzban=None) -> AsyncIterator[List[Dict]]:
+    """Транзакции пачками по возрастанию id"""
+    async for batch in iter_transactions_batches():
+        yield [{field: row.get(field) for field in TRANSACTION_FIELDS} for row in batch]
+
+EXPORTS = {
+    "users": (USER_FIELDS, iter_user_rows),
+    "transactions": (TRANSACTION_FIELDS, iter_transaction_rows)
+}
+
+def _encode_csv(rows: List[Dict], fields: Sequence[str], header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+def _encode_jsonl(rows: List[Dict], fields: Sequence[str], header: bool) -> bytes:
+    return "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows).encode()
+
+_ENCODERS = {"csv": _encode_csv, "jsonl": _encode_jsonl}
+
+async def _iter_chunks(table: str, fmt: str, marzban) -> AsyncIterator[Tuple[bytes, int]]:
+    """(фрагмент файла, число строк в нем) - по одному на пачку"""
+    if table not in EXPORTS:
+        raise ValueError(f"Неизвестная выгрузка: {table}")
+    if fmt not in _ENCODERS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    fields, iter_rows = EXPORTS[table]
+    encode = _ENCODERS[fmt]
+    if fmt == "csv":
+        # Заголовок отдельным фрагментом: файл валиден, даже если строк нет
+        yield encode([], fields, True), 0
+    async for rows in iter_rows(marzban):
+        yield encode(rows, fields, False), len(rows)
+
+async def iter_export(table: str, fmt: str, marzban) -> AsyncIterator[bytes]:
+    """Выгрузка table ("users" или "transactions") в формате fmt ("csv" или "jsonl") фрагментами"""
+    async for chunk, _ in _iter_chunks(table, fmt, marzban):
+        yield chunk
+
+async def export_to_file(table: str, fmt: str, marzban, path: str) -> int:
+    """Записать выгрузку в файл; вернуть число строк"""
+    count = 0
+    started = time.perf_counter()
+    with open(path, "wb") as f:
+        async for chunk, rows in _iter_chunks(table, fmt, marzban):
+            f.write(chunk)
+            count += rows
+    logger.info(f"Выгрузка {table}.{fmt}: {count} строк за {time.perf_counter() - started:.1f} сек")
+    return count
+
+def gzip_file(path: str) -> str:
+    """Сжать файл рядом с исходным (<path>.gz), исходный удаляется; вернуть путь архива"""
+    gz_path = f"{path}.gz"
+    with open(path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return gz_path
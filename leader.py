@@ -0,0 +1,47 @@
+import asyncio
+import fcntl
+import logging
+import os
+from typing import Optional
+from config import LEADER_LOCK_PATH, LEADER_RETRY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class LeaderLock:
+    """Выбор одного процесса-лидера среди воркеров на одной машине
+
+    Лидер держит эксклюзивный flock на файле. Блокировку снимает ОС при завершении
+    процесса, поэтому после падения лидера ее забирает один из оставшихся воркеров.
+    """
+
+    def __init__(self, path: str = LEADER_LOCK_PATH):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        """Попробовать стать лидером без ожидания"""
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # pid текущего лидера - для диагностики
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    async def acquire(self, retry_interval: float = LEADER_RETRY_SECONDS):
+        """Дождаться лидерства, проверяя блокировку раз в retry_interval секунд"""
+        while not self.try_acquire():
+            await asyncio.sleep(retry_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
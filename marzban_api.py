@@ -1,64 +1,557 @@
 import aiohttp
+import asyncio
+import base64
+import bisect
+import hashlib
 import json
+import logging
+import re
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from config import MARZBAN_API_URL, MARZBAN_USERNAME, MARZBAN_PASSWORD
+from snapshot import UserSnapshot
+from metrics import REGISTRY, stats_samples
+from database import get_user_node, count_users_by_node, acquire_user_write_lock, release_user_write_lock
+from config import (
+    MARZBAN_USERNAME, MARZBAN_PASSWORD,
+    MARZBAN_POOL_LIMIT, MARZBAN_POOL_LIMIT_PER_HOST, MARZBAN_DNS_CACHE_TTL,
+    MARZBAN_KEEPALIVE_TIMEOUT, MARZBAN_REQUEST_TIMEOUT, MARZBAN_CONNECT_TIMEOUT,
+    MARZBAN_TOKEN_REFRESH_MARGIN, MARZBAN_TOKEN_MIN_REFRESH_INTERVAL,
+    MARZBAN_USER_CACHE_TTL, MARZBAN_USER_CACHE_SIZE, MARZBAN_USER_CACHE_MAX_BYTES,
+    MARZBAN_USERS_PAGE_SIZE, MARZBAN_USERS_PAGE_CONCURRENCY, MARZBAN_WRITE_LOCK_TTL,
+    MARZBAN_NODES, MARZBAN_PLACEMENT, MARZBAN_PLACEMENT_CACHE_SIZE, MARZBAN_NODE_COUNTS_TTL
+)
 
-class MarzbanAPI:
-    def __init__(self):
-        self.base_url = MARZBAN_API_URL
-        self.username = MARZBAN_USERNAME
-        self.password = MARZBAN_PASSWORD
+logger = logging.getLogger(__name__)
+
+MARZBAN_REQUEST_SECONDS = REGISTRY.histogram(
+    "marzban_request_duration_seconds", "Время запросов к Marzban API", ["node", "method", "endpoint"]
+)
+MARZBAN_RESPONSES = REGISTRY.counter(
+    "marzban_responses_total", "Ответы Marzban API по кодам (error - запрос не выполнен)",
+    ["node", "method", "endpoint", "status"]
+)
+
+# /api/user/<username>/reset -> /api/user/{username}/reset: метки не должны зависеть от пользователя
+_USER_ENDPOINT = re.compile(r"^/api/user/[^/]+")
+
+def _endpoint_label(endpoint):
+    return _USER_ENDPOINT.sub("/api/user/{username}", endpoint)
+
+def decode_jwt_expiry(token):
+    """Достать exp (Unix timestamp) из JWT без проверки подписи"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else None
+    except (IndexError, ValueError, AttributeError, TypeError):
+        return None
+
+class TokenManager:
+    """Токен администратора Marzban: общий логин для всех корутин и упреждающее обновление"""
+    
+    def __init__(self, fetch_token, refresh_margin=MARZBAN_TOKEN_REFRESH_MARGIN,
+                 min_refresh_interval=MARZBAN_TOKEN_MIN_REFRESH_INTERVAL):
+        self._fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
         self.token = None
+        self.expires_at = None
+        self.fetched_at = None
+        # Lock создается при первом использовании: экземпляр MarzbanAPI живет на уровне модуля
+        self._lock = None
+        self._refresh_task = None
+        self.stats = {
+            "logins": 0,
+            "login_failures": 0,
+            "proactive_refreshes": 0,
+            "reactive_refreshes": 0,
+            "coalesced_waits": 0
+        }
     
-    async def login(self):
-        """Авторизация в Marzban API"""
-        async with aiohttp.ClientSession() as session:
-            # Используем FormData вместо JSON
-            data = aiohttp.FormData()
-            data.add_field('username', self.username)
-            data.add_field('password', self.password)
-            data.add_field('grant_type', 'password')
-            
-            async with session.post(
-                f"{self.base_url}/api/admin/token",
-                data=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    self.token = result.get("access_token")
-                    return True
-                return False
-    
-    async def _request(self, method, endpoint, **kwargs):
-        """Выполнение запроса к API"""
+    def _margin(self):
+        """Запас до истечения: refresh_margin, но не больше половины срока жизни токена
+        
+        Иначе токен, живущий меньше refresh_margin, считался бы устаревшим сразу после логина.
+        """
+        if self.expires_at is None or self.fetched_at is None:
+            return self.refresh_margin
+        return min(self.refresh_margin, max(self.expires_at - self.fetched_at, 0) / 2)
+    
+    def _is_fresh(self):
+        """Токен есть и не истекает в ближайшие _margin() секунд"""
         if not self.token:
-            await self.login()
+            return False
+        if self.expires_at is None:
+            return True
+        return time.time() < self.expires_at - self._margin()
+    
+    async def get_token(self):
+        """Вернуть действующий токен, при необходимости дождавшись логина"""
+        if self._is_fresh():
+            return self.token
+        return await self.refresh()
+    
+    async def refresh(self, reason=None, stale_token=None):
+        """Обновить токен; параллельные вызовы ждут один общий логин
         
-        headers = {"Authorization": f"Bearer {self.token}"}
+        reason - "proactive" или "reactive" (для счетчиков)
+        stale_token - токен, с которым получили 401: если его уже заменили, повторный логин не нужен
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._lock.locked():
+            self.stats["coalesced_waits"] += 1
+        
+        async with self._lock:
+            if stale_token is not None and self.token and self.token != stale_token:
+                return self.token
+            if stale_token is None and reason is None and self._is_fresh():
+                return self.token
+            
+            token = await self._fetch_token()
+            if not token:
+                self.stats["login_failures"] += 1
+                logger.error("Не удалось получить токен Marzban API")
+                return None
+            
+            self.token = token
+            self.expires_at = decode_jwt_expiry(token)
+            self.fetched_at = time.time()
+            self.stats["logins"] += 1
+            if reason:
+                self.stats[f"{reason}_refreshes"] += 1
+            logger.info(f"Токен Marzban API обновлен ({reason or 'login'}), счетчики: {self.stats}")
+            
+            self._schedule_refresh()
+            return token
+    
+    def _schedule_refresh(self):
+        """Запланировать фоновое обновление токена до его истечения"""
+        if self.expires_at is None:
+            return
+        
+        current = asyncio.current_task()
+        if self._refresh_task and not self._refresh_task.done() and self._refresh_task is not current:
+            self._refresh_task.cancel()
+        self._refresh_task = asyncio.create_task(self._refresh_later())
+    
+    async def _refresh_later(self):
+        """Фоновая задача: обновить токен за _margin() секунд до истечения
+        
+        Между фоновыми логинами проходит не меньше min_refresh_interval секунд, даже если
+        панель выдает уже истекающие токены (например, часы панели спешат).
+        """
+        delay = self.expires_at - self._margin() - time.time()
+        try:
+            await asyncio.sleep(max(delay, self.min_refresh_interval))
+            await self.refresh("proactive", stale_token=self.token)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка при фоновом обновлении токена Marzban: {e}")
+    
+    async def stop(self):
+        """Остановить фоновое обновление"""
+        if self._refresh_task and not self._refresh_task.done():
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+        self._refresh_task = None
+
+class UserCache:
+    """LRU-кэш пользователей Marzban с TTL, ограничением памяти и объединением параллельных запросов"""
+    
+    def __init__(self, ttl=MARZBAN_USER_CACHE_TTL, max_entries=MARZBAN_USER_CACHE_SIZE,
+                 max_bytes=MARZBAN_USER_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # username -> (expires_at, size, user)
+        self._inflight = {}  # username -> Future текущего запроса
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+    
+    def get(self, username):
+        """Вернуть пользователя из кэша или None, если записи нет или она устарела"""
+        entry = self._entries.get(username)
+        if not entry:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(username)
+            return None
+        self._entries.move_to_end(username)
+        return entry[2]
+    
+    def set(self, username, user):
+        """Положить пользователя в кэш (например, из ответа на PUT)"""
+        # Параллельный GET начался до записи и вернет устаревшие данные - не сохраняем его
+        self._inflight.pop(username, None)
+        self._drop(username)
+        if self.ttl <= 0:
+            return
+        
+        size = len(json.dumps(user, ensure_ascii=False))
+        self._entries[username] = (time.monotonic() + self.ttl, size, user)
+        self._bytes += size
+        
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats["evictions"] += 1
+    
+    def invalidate(self, username):
+        """Удалить пользователя из кэша"""
+        self._inflight.pop(username, None)
+        self._drop(username)
+    
+    def _drop(self, username):
+        entry = self._entries.pop(username, None)
+        if entry:
+            self._bytes -= entry[1]
+    
+    async def get_or_fetch(self, username, fetch):
+        """Вернуть пользователя из кэша; параллельные промахи ждут один общий запрос fetch()"""
+        user = self.get(username)
+        if user is not None:
+            self.stats["hits"] += 1
+            return user
+        
+        future = self._inflight.get(username)
+        if future:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(future)
+        
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[username] = future
+        try:
+            user = await fetch()
+        except asyncio.CancelledError:
+            if self._inflight.get(username) is future:
+                del self._inflight[username]
+            future.cancel()
+            raise
+        except Exception as e:
+            if self._inflight.get(username) is future:
+                del self._inflight[username]
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, помечаем его как полученное
+            future.exception()
+            raise
+        
+        if self._inflight.get(username) is future:
+            del self._inflight[username]
+            if user:
+                self.set(username, user)
+        future.set_result(user)
+        return user
+
+class UserLocks:
+    """Реестр asyncio.Lock по username
+    
+    Блокировки хранятся по слабым ссылкам: пока ее держит или ждет хотя бы одна корутина,
+    она в реестре, потом удаляется сборщиком мусора. Память ограничена числом активных записей.
+    """
+    
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+    
+    def get(self, username):
+        lock = self._locks.get(username)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[username] = lock
+        return lock
+    
+    def __len__(self):
+        return len(self._locks)
+
+class MarzbanNode:
+    """Одна панель Marzban: адрес, учетные данные и собственный токен администратора"""
+    
+    def __init__(self, name, base_url, username, password, get_session, weight=1):
+        self.name = name
+        self.base_url = base_url.rstrip("/") if base_url else base_url
+        self.username = username
+        self.password = password
+        self.weight = max(float(weight), 0.0)
+        self._get_session = get_session
+        self.tokens = TokenManager(self._fetch_token)
+    
+    async def _fetch_token(self):
+        """Запрос нового токена у /api/admin/token"""
+        session = await self._get_session()
+        
+        # Используем FormData вместо JSON
+        data = aiohttp.FormData()
+        data.add_field('username', self.username)
+        data.add_field('password', self.password)
+        data.add_field('grant_type', 'password')
+        
+        async with session.post(
+            f"{self.base_url}/api/admin/token",
+            data=data
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result.get("access_token")
+            return None
+    
+    async def request(self, method, endpoint, timeout=None, **kwargs):
+        """Выполнение запроса к API этой панели
+        
+        timeout - таймаут этого запроса в секундах (по умолчанию MARZBAN_REQUEST_TIMEOUT)
+        """
+        token = await self.tokens.get_token()
+        
+        session = await self._get_session()
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        
+        headers = {"Authorization": f"Bearer {token}"}
         headers.update(kwargs.pop("headers", {}))
+        endpoint_label = _endpoint_label(endpoint)
         
-        async with aiohttp.ClientSession() as session:
+        async with self._send(session, method, endpoint, endpoint_label, headers, kwargs) as response:
+            if response.status == 401:
+                # Токен истек: ждем общий перелогин вместо собственного
+                token = await self.tokens.refresh("reactive", stale_token=token)
+                headers["Authorization"] = f"Bearer {token}"
+                async with self._send(session, method, endpoint, endpoint_label, headers, kwargs) as retry_response:
+                    return await retry_response.json() if retry_response.status == 200 else None
+            
+            if response.status in [200, 201]:
+                return await response.json()
+            return None
+    
+    @asynccontextmanager
+    async def _send(self, session, method, endpoint, endpoint_label, headers, kwargs):
+        """Запрос к API с учетом времени и кода ответа в метриках"""
+        started = time.perf_counter()
+        status = "error"
+        try:
             async with session.request(
                 method,
                 f"{self.base_url}{endpoint}",
                 headers=headers,
                 **kwargs
             ) as response:
-                if response.status == 401:
-                    # Токен истек, перелогиниваемся
-                    await self.login()
-                    headers["Authorization"] = f"Bearer {self.token}"
-                    async with session.request(
-                        method,
-                        f"{self.base_url}{endpoint}",
-                        headers=headers,
-                        **kwargs
-                    ) as retry_response:
-                        return await retry_response.json() if retry_response.status == 200 else None
-                
-                if response.status in [200, 201]:
-                    return await response.json()
-                return None
+                status = response.status
+                yield response
+        finally:
+            MARZBAN_REQUEST_SECONDS.labels(self.name, method, endpoint_label).observe(time.perf_counter() - started)
+            MARZBAN_RESPONSES.labels(self.name, method, endpoint_label, status).inc()
+
+class HashRing:
+    """Consistent hashing: при добавлении панели переезжает только часть новых назначений"""
+    
+    VIRTUAL_NODES = 100
+    
+    def __init__(self, nodes):
+        self._ring = sorted(
+            (self._hash(f"{node.name}#{i}"), node)
+            for node in nodes
+            for i in range(int(self.VIRTUAL_NODES * node.weight))
+        )
+        self._keys = [key for key, _ in self._ring]
+    
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+    
+    def get(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+class MarzbanAPI:
+    """Клиент пула панелей Marzban
+    
+    Чтения и записи пользователя идут на его панель (колонка users.node, NULL - основная,
+    то есть первая в MARZBAN_NODES). Новые пользователи размещаются по MARZBAN_PLACEMENT.
+    Кэш, read-модель и блокировки общие: username уникален во всем пуле.
+    """
+    
+    def __init__(self, nodes=None, placement=MARZBAN_PLACEMENT):
+        self.nodes = [
+            MarzbanNode(
+                name=node.get("name") or f"node{i}",
+                base_url=node.get("url"),
+                username=node.get("username", MARZBAN_USERNAME),
+                password=node.get("password", MARZBAN_PASSWORD),
+                get_session=self._get_session,
+                weight=node.get("weight", 1)
+            )
+            for i, node in enumerate(nodes or MARZBAN_NODES)
+        ]
+        self.primary = self.nodes[0]
+        self._nodes_by_name = {node.name: node for node in self.nodes}
+        self.placement_strategy = placement
+        self._ring = HashRing(self.nodes)
+        self._placement = OrderedDict()  # username -> имя панели (LRU)
+        self._node_counts = None  # имя панели -> пользователей (для least_load)
+        self._node_counts_at = 0.0
+        self.users_cache = UserCache()
+        self.snapshot = UserSnapshot()
+        self.user_locks = UserLocks()
+        self.write_stats = {"writes": 0, "lock_waits": 0, "lock_timeouts": 0}
+        self._session = None
+    
+    @property
+    def base_url(self):
+        return self.primary.base_url
+    
+    @property
+    def tokens(self):
+        """TokenManager основной панели"""
+        return self.primary.tokens
+    
+    @property
+    def token(self):
+        """Текущий токен администратора основной панели"""
+        return self.primary.tokens.token
+    
+    async def start(self):
+        """Открыть долгоживущую сессию с пулом keep-alive соединений (общую для всех панелей)"""
+        if self._session and not self._session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=MARZBAN_POOL_LIMIT,
+            limit_per_host=MARZBAN_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=MARZBAN_DNS_CACHE_TTL,
+            keepalive_timeout=MARZBAN_KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=MARZBAN_REQUEST_TIMEOUT,
+            sock_connect=MARZBAN_CONNECT_TIMEOUT
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.info(
+            f"Сессия Marzban API открыта (панелей: {len(self.nodes)}, пул: {MARZBAN_POOL_LIMIT}, "
+            f"на хост: {MARZBAN_POOL_LIMIT_PER_HOST})"
+        )
+    
+    async def close(self):
+        """Закрыть сессию и все соединения пула"""
+        for node in self.nodes:
+            await node.tokens.stop()
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("Сессия Marzban API закрыта")
+        self._session = None
+    
+    async def _get_session(self):
+        """Вернуть текущую сессию, открыв ее при первом обращении"""
+        if not self._session or self._session.closed:
+            await self.start()
+        return self._session
+    
+    async def login(self):
+        """Авторизация во всех панелях Marzban"""
+        results = await asyncio.gather(
+            *(node.tokens.refresh("reactive" if node.tokens.token else None) for node in self.nodes)
+        )
+        return all(token is not None for token in results)
+    
+    async def _request(self, method, endpoint, timeout=None, node=None, **kwargs):
+        """Выполнение запроса к API панели node (по умолчанию основной)"""
+        return await (node or self.primary).request(method, endpoint, timeout=timeout, **kwargs)
+    
+    def _remember_placement(self, username, node_name):
+        self._placement[username] = node_name
+        self._placement.move_to_end(username)
+        while len(self._placement) > MARZBAN_PLACEMENT_CACHE_SIZE:
+            self._placement.popitem(last=False)
+    
+    async def node_for(self, username):
+        """Панель, на которой живет пользователь"""
+        if len(self.nodes) == 1:
+            return self.primary
+        
+        name = self._placement.get(username)
+        if name is None:
+            name = await get_user_node(username) or self.primary.name
+            self._remember_placement(username, name)
+        else:
+            self._placement.move_to_end(username)
+        
+        node = self._nodes_by_name.get(name)
+        if node is None:
+            logger.error(f"Панель {name} пользователя {username} не настроена, используется основная")
+            return self.primary
+        return node
+    
+    def placement(self, username):
+        """Имя панели пользователя для записи в users.node (None - основная или неизвестна)"""
+        if len(self.nodes) == 1:
+            return None
+        return self._placement.get(username)
+    
+    async def _place_new_user(self, username):
+        """Выбрать панель для нового пользователя"""
+        if len(self.nodes) == 1:
+            return self.primary
+        
+        # Пользователь уже был размещен (пересоздание) - остается на своей панели
+        recorded = self._placement.get(username) or await get_user_node(username)
+        if recorded in self._nodes_by_name:
+            self._remember_placement(username, recorded)
+            return self._nodes_by_name[recorded]
+        
+        if self.placement_strategy == "least_load":
+            counts = await self._get_node_counts()
+            candidates = [node for node in self.nodes if node.weight > 0] or self.nodes
+            node = min(candidates, key=lambda n: counts.get(n.name, 0) / (n.weight or 1))
+            counts[node.name] = counts.get(node.name, 0) + 1
+            return node
+        return self._ring.get(username) or self.primary
+    
+    async def _get_node_counts(self):
+        """Пользователи по панелям из БД (кэшируются на MARZBAN_NODE_COUNTS_TTL)"""
+        if self._node_counts is None or time.monotonic() - self._node_counts_at > MARZBAN_NODE_COUNTS_TTL:
+            counts = {}
+            for name, count in (await count_users_by_node()).items():
+                name = name or self.primary.name
+                counts[name] = counts.get(name, 0) + count
+            self._node_counts = counts
+            self._node_counts_at = time.monotonic()
+        return self._node_counts
+    
+    def register_metrics(self):
+        """Выдавать в /metrics счетчики токена, кэша, read-модели и записей этого экземпляра"""
+        REGISTRY.callback(
+            "marzban_token_events_total", "Логины и обновления токена Marzban", ["node", "event"], "counter",
+            lambda: [((node.name, event), value) for node in self.nodes for event, value in node.tokens.stats.items()]
+        )
+        REGISTRY.callback(
+            "marzban_user_cache_events_total", "Обращения к кэшу пользователей Marzban", ["event"], "counter",
+            lambda: stats_samples(self.users_cache.stats)
+        )
+        REGISTRY.callback(
+            "marzban_user_cache_entries", "Записей в кэше пользователей Marzban", (), "gauge",
+            lambda: [((), len(self.users_cache._entries))]
+        )
+        REGISTRY.callback(
+            "marzban_user_cache_bytes", "Оценка объема кэша пользователей Marzban", (), "gauge",
+            lambda: [((), self.users_cache._bytes)]
+        )
+        REGISTRY.callback(
+            "user_snapshot_reads_total", "Чтения read-модели пользователей", ["result"], "counter",
+            lambda: stats_samples(self.snapshot.stats)
+        )
+        REGISTRY.callback(
+            "marzban_writes_total", "Изменения пользователей Marzban", ["kind"], "counter",
+            lambda: stats_samples(self.write_stats)
+        )
     
     async def create_user(self, username, data_limit_gb=None, expire_days=None):
         """Создание пользователя с VLESS + Reality"""
@@ -82,69 +575,262 @@ class MarzbanAPI:
             "expire": expire_timestamp
         }
         
-        return await self._request("POST", "/api/user", json=payload)
+        node = await self._place_new_user(username)
+        result = await self._request("POST", "/api/user", node=node, json=payload)
+        await self._remember_write(username, result)
+        if result and len(self.nodes) > 1:
+            self._remember_placement(username, node.name)
+            logger.info(f"Пользователь {username} создан на панели {node.name}")
+        return result
+    
+    async def adopt_user(self, username):
+        """Найти пользователя, уже созданного в Marzban (например, оборванным прошлым запуском)
+        
+        Сначала ищется на панели, которую create_user выбрал бы для него, затем на остальных;
+        найденная панель запоминается для placement() и последующих запросов.
+        """
+        placed = await self._place_new_user(username)
+        for node in [placed] + [node for node in self.nodes if node is not placed]:
+            user = await self._request("GET", f"/api/user/{username}", node=node)
+            if user:
+                if len(self.nodes) > 1:
+                    self._remember_placement(username, node.name)
+                self._remember_user(username, user)
+                return user
+        return None
+    
+    def _remember_user(self, username, result):
+        """Обновить кэш по ответу Marzban: сохранить пользователя или сбросить запись"""
+        if isinstance(result, dict) and result.get("username") == username:
+            self.users_cache.set(username, result)
+        else:
+            self.users_cache.invalidate(username)
+    
+    async def _remember_write(self, username, result):
+        """После собственной записи: кэш и read-модель, общая для всех процессов"""
+        self._remember_user(username, result)
+        if isinstance(result, dict) and result.get("username") == username:
+            await self.snapshot.record(result)
+        else:
+            # Неизвестно, применилась ли запись - строка прохода больше не верна
+            await self.snapshot.discard(username)
+    
+    async def _fetch_user(self, username):
+        return await self._request("GET", f"/api/user/{username}", node=await self.node_for(username))
+    
+    async def get_user(self, username, use_cache=True):
+        """Получить информацию о пользователе
+        
+        use_cache=False - всегда запрашивать Marzban (ответ все равно попадет в кэш)
+        """
+        if not use_cache:
+            user = await self._fetch_user(username)
+            self._remember_user(username, user)
+            return user
+        return await self.users_cache.get_or_fetch(username, lambda: self._fetch_user(username))
     
-    async def get_user(self, username):
-        """Получить информацию о пользователе"""
-        return await self._request("GET", f"/api/user/{username}")
+    async def get_user_status(self, username, max_age=None):
+        """Данные пользователя для экранов статуса
+        
+        Берутся из read-модели (последний проход планировщика или запись любого процесса),
+        если они не старше max_age секунд (по умолчанию SNAPSHOT_MAX_AGE_SECONDS), иначе из Marzban.
+        """
+        user = await self.snapshot.get(username, max_age)
+        if user is not None:
+            return user
+        return await self.get_user(username)
     
     async def get_user_config(self, username):
-        """Получить конфигурацию пользователя"""
+        """Получить конфигурацию пользователя (первую ссылку из links)
+        
+        Ссылку формирует панель с учетом ее хостов и inbound пользователя; пользователь
+        берется через кэш get_user, а не из read-модели: inbound меняется при переходе
+        в бесплатный режим, в том числе из другого процесса.
+        """
         user = await self.get_user(username)
         if user and user.get("links"):
-            # Возвращаем первую ссылку из массива links
-            return user["links"][0] if user["links"] else None
+            return user["links"][0]
         return None
     
     async def delete_user(self, username):
         """Удалить пользователя"""
-        return await self._request("DELETE", f"/api/user/{username}")
+        result = await self._request("DELETE", f"/api/user/{username}", node=await self.node_for(username))
+        self.users_cache.invalidate(username)
+        await self.snapshot.discard(username)
+        return result
     
     async def get_users(self):
-        """Получить список всех пользователей"""
-        return await self._request("GET", "/api/users")
+        """Получить список всех пользователей (со всех панелей)"""
+        results = await asyncio.gather(*(self._request("GET", "/api/users", node=node) for node in self.nodes))
+        if len(results) == 1:
+            return results[0]
+        results = [result for result in results if result]
+        if not results:
+            return None
+        return {
+            "users": [user for result in results for user in result.get("users", [])],
+            "total": sum(result.get("total", 0) for result in results)
+        }
+    
+    async def _get_users_page(self, offset, limit, node=None):
+        """Одна страница /api/users"""
+        return await self._request("GET", "/api/users", node=node, params={"offset": offset, "limit": limit})
+    
+    async def iter_users_pages(self, page_size=MARZBAN_USERS_PAGE_SIZE, concurrency=MARZBAN_USERS_PAGE_CONCURRENCY):
+        """Постранично получить всех пользователей всех панелей (async-генератор списков)
+        
+        Панели обходятся параллельно, на каждой не более concurrency запросов страниц
+        одновременно; страницы отдаются по мере готовности (порядок не гарантирован).
+        """
+        if len(self.nodes) == 1:
+            async for page in self._iter_node_pages(self.primary, page_size, concurrency):
+                yield page
+            return
+        
+        # Небольшая очередь - панели не обгоняют обработку больше, чем на страницу
+        queue = asyncio.Queue(maxsize=len(self.nodes))
+        finished = object()
+        
+        async def pump(node):
+            try:
+                async for page in self._iter_node_pages(node, page_size, concurrency):
+                    await queue.put(page)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка при обходе пользователей панели {node.name}: {e}")
+            await queue.put(finished)
+        
+        tasks = [asyncio.create_task(pump(node)) for node in self.nodes]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                page = await queue.get()
+                if page is finished:
+                    remaining -= 1
+                    continue
+                yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def _iter_node_pages(self, node, page_size, concurrency):
+        """Постранично получить пользователей одной панели
+        
+        Первая страница сообщает total, остальные запрашиваются параллельно, но не более
+        concurrency одновременно. Страница, которую не удалось получить, пропускается с предупреждением.
+        """
+        first = await self._get_users_page(0, page_size, node)
+        if not first:
+            logger.warning(f"Не удалось получить первую страницу пользователей Marzban ({node.name})")
+            return
+        
+        total = first.get("total", 0)
+        yield first.get("users", [])
+        del first
+        
+        offsets = iter(range(page_size, total, page_size))
+        pending = {}
+        
+        def schedule_next():
+            offset = next(offsets, None)
+            if offset is not None:
+                task = asyncio.create_task(self._get_users_page(offset, page_size, node))
+                pending[task] = offset
+        
+        for _ in range(max(1, concurrency)):
+            schedule_next()
+        
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    offset = pending.pop(task)
+                    schedule_next()
+                    try:
+                        page = task.result()
+                    except Exception as e:
+                        logger.warning(f"Ошибка при получении страницы пользователей {node.name} (offset={offset}): {e}")
+                        continue
+                    if not page:
+                        logger.warning(f"Не удалось получить страницу пользователей {node.name} (offset={offset})")
+                        continue
+                    yield page.get("users", [])
+        finally:
+            for task in pending:
+                task.cancel()
     
     async def reset_user_data(self, username):
         """Сбросить статистику пользователя"""
-        return await self._request("POST", f"/api/user/{username}/reset")
+        result = await self._request("POST", f"/api/user/{username}/reset", node=await self.node_for(username))
+        await self._remember_write(username, result)
+        return result
     
-    async def update_user_inbounds(self, username, inbounds_list):
-        """Обновить inbound пользователя"""
-        user = await self.get_user(username)
-        if not user:
-            return None
+    @asynccontextmanager
+    async def _write_lock(self, username):
+        """Очередь записей пользователя: asyncio.Lock в процессе и аренда в SQLite между процессами
         
-        payload = {
-            "username": username,
-            "proxies": user.get("proxies", {}),
-            "inbounds": {
-                "vless": inbounds_list
-            },
-            "data_limit": user.get("data_limit", 0),
-            "expire": user.get("expire", 0)
-        }
+        Бот и воркеры Web App работают с одной БД, поэтому покупки пользователя из разных
+        процессов не выполняют GET и PUT одновременно. Возвращает False, если аренду не
+        удалось получить за MARZBAN_WRITE_LOCK_TTL секунд.
+        """
+        async with self.user_locks.get(username):
+            owner = uuid.uuid4().hex
+            deadline = time.monotonic() + MARZBAN_WRITE_LOCK_TTL
+            delay = 0.02
+            acquired = await acquire_user_write_lock(username, owner, MARZBAN_WRITE_LOCK_TTL)
+            if not acquired:
+                self.write_stats["lock_waits"] += 1
+            while not acquired and time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                acquired = await acquire_user_write_lock(username, owner, MARZBAN_WRITE_LOCK_TTL)
+            if not acquired:
+                self.write_stats["lock_timeouts"] += 1
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    await release_user_write_lock(username, owner)
+    
+    async def modify_user(self, username, data_limit_delta=0, inbounds_list=None):
+        """Изменить пользователя: прибавить data_limit_delta байт и/или сменить vless inbound
         
-        return await self._request("PUT", f"/api/user/{username}", json=payload)
+        Записи одного пользователя выполняются по очереди во всех процессах (_write_lock),
+        а PUT строится от свежего GET, сделанного уже под блокировкой: кэш может не знать
+        об изменении, сделанном другим процессом, и прибавка потерялась бы.
+        """
+        async with self._write_lock(username) as acquired:
+            if not acquired:
+                logger.error(f"Не удалось дождаться очереди записи пользователя {username}")
+                return None
+            self.write_stats["writes"] += 1
+            
+            user = await self.get_user(username, use_cache=False)
+            if not user:
+                return None
+            
+            payload = {
+                "username": username,
+                "proxies": user.get("proxies", {}),
+                "inbounds": {"vless": inbounds_list} if inbounds_list is not None else user.get("inbounds", {}),
+                "data_limit": (user.get("data_limit") or 0) + data_limit_delta,
+                "expire": user.get("expire", 0)
+            }
+            
+            result = await self._request(
+                "PUT", f"/api/user/{username}", node=await self.node_for(username), json=payload
+            )
+            await self._remember_write(username, result)
+            return result
+    
+    async def update_user_inbounds(self, username, inbounds_list):
+        """Обновить inbound пользователя"""
+        return await self.modify_user(username, inbounds_list=inbounds_list)
     
     async def add_traffic(self, username, additional_gb):
         """Добавить трафик пользователю (в байтах)"""
-        user = await self.get_user(username)
-        if not user:
-            return None
-        
-        current_limit = user.get("data_limit", 0)
-        additional_bytes = additional_gb * 1024 * 1024 * 1024
-        new_limit = current_limit + additional_bytes
-        
-        payload = {
-            "username": username,
-            "proxies": user.get("proxies", {}),
-            "inbounds": user.get("inbounds", {}),
-            "data_limit": new_limit,
-            "expire": user.get("expire", 0)
-        }
-        
-        return await self._request("PUT", f"/api/user/{username}", json=payload)
+        return await self.modify_user(username, data_limit_delta=additional_gb * 1024 * 1024 * 1024)
     
     async def switch_to_free_mode(self, username):
         """Переключить пользователя на бесплатный режим (медленный inbound + сброс лимита)"""
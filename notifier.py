@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+)
+from metrics import REGISTRY, stats_samples
+from config import (
+    NOTIFY_WORKERS, NOTIFY_QUEUE_SIZE, NOTIFY_MAX_ATTEMPTS,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE
+)
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Token bucket с резервированием: возвращает, сколько ждать до своего слота"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """Занять токен; вернуть задержку в секундах до момента, когда его можно тратить"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """Bucket полностью восстановился (можно выбросить без потери состояния)"""
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+class Notification:
+    """Сообщение в очереди рассылки"""
+    __slots__ = ("chat_id", "text", "kwargs", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id: int, text: str, kwargs: dict):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class NotificationDispatcher:
+    """Очередь уведомлений с пулом воркеров и лимитами Telegram (общим и на чат)"""
+
+    MAX_CHAT_BUCKETS = 10000
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, bot: Bot, workers: int = NOTIFY_WORKERS, queue_size: int = NOTIFY_QUEUE_SIZE,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE, per_chat_rate: float = TELEGRAM_PER_CHAT_RATE,
+                 max_attempts: int = NOTIFY_MAX_ATTEMPTS):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.per_chat_rate = per_chat_rate
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket
+        self._paused_until = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.counters = {"enqueued": 0, "sent": 0, "failed": 0, "retried": 0, "dropped": 0}
+
+    async def start(self):
+        """Запустить воркеры"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"notifier-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Диспетчер уведомлений запущен ({self.workers} воркеров)")
+
+    async def stop(self, drain_timeout: float = 10):
+        """Дождаться отправки очереди (не дольше drain_timeout) и остановить воркеры"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Диспетчер остановлен, в очереди осталось {self._queue.qsize()} уведомлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Диспетчер уведомлений остановлен")
+
+    def enqueue(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Поставить сообщение в очередь; False, если очередь переполнена или не запущена"""
+        if self._queue is None:
+            logger.error("Диспетчер уведомлений не запущен")
+            return False
+        try:
+            self._queue.put_nowait(Notification(chat_id, text, kwargs))
+        except asyncio.QueueFull:
+            self.counters["dropped"] += 1
+            logger.warning(f"Очередь уведомлений переполнена, сообщение для {chat_id} отброшено")
+            return False
+        self.counters["enqueued"] += 1
+        return True
+
+    def stats(self) -> dict:
+        """Глубина очереди, счетчики и задержка доставки (от постановки в очередь) в секундах"""
+        latencies = sorted(self._latencies)
+        result = dict(self.counters)
+        result["queue_depth"] = self._queue.qsize() if self._queue else 0
+        if latencies:
+            result["latency_avg"] = sum(latencies) / len(latencies)
+            result["latency_p50"] = latencies[len(latencies) // 2]
+            result["latency_p99"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            result["latency_max"] = latencies[-1]
+        return result
+
+    def register_metrics(self):
+        """Выдавать в /metrics счетчики, глубину очереди и задержку доставки"""
+        REGISTRY.callback(
+            "notifications_total", "Уведомления диспетчера по исходу", ["outcome"], "counter",
+            lambda: stats_samples(self.counters)
+        )
+        REGISTRY.callback(
+            "notifications_queue_depth", "Уведомлений в очереди", (), "gauge",
+            lambda: [((), self._queue.qsize() if self._queue else 0)]
+        )
+        REGISTRY.callback(
+            "notifications_delivery_latency_seconds",
+            f"Задержка доставки от постановки в очередь (последние {self.LATENCY_WINDOW})",
+            ["stat"], "gauge",
+            lambda: [((key[len("latency_"):],), value) for key, value in self.stats().items()
+                     if key.startswith("latency_")]
+        )
+    
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, capacity=1)
+            self._chat_buckets[chat_id] = bucket
+            # Ограничиваем память: выбрасываем самые старые восстановившиеся bucket'ы
+            while len(self._chat_buckets) > self.MAX_CHAT_BUCKETS:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if not oldest.is_full(now):
+                    break
+                del self._chat_buckets[oldest_id]
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_for_slot(self, chat_id: int):
+        """Дождаться общего и персонального лимита; отправки распределяются по секунде"""
+        now = time.monotonic()
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+            now = time.monotonic()
+        delay = max(self._global_bucket.reserve(now), self._chat_bucket(chat_id, now).reserve(now))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            notification = await self._queue.get()
+            try:
+                await self._deliver(notification)
+            except Exception as e:
+                self.counters["failed"] += 1
+                logger.error(f"Ошибка при отправке уведомления пользователю {notification.chat_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, notification: Notification):
+        while True:
+            notification.attempts += 1
+            await self._wait_for_slot(notification.chat_id)
+            try:
+                await self.bot.send_message(
+                    chat_id=notification.chat_id,
+                    text=notification.text,
+                    **notification.kwargs
+                )
+            except TelegramRetryAfter as e:
+                # Flood control: все воркеры ждут указанное Telegram время
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"Telegram просит подождать {e.retry_after} сек (чат {notification.chat_id})")
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Временная ошибка отправки пользователю {notification.chat_id}: {e}")
+                await asyncio.sleep(min(2 ** notification.attempts, 30))
+            else:
+                self.counters["sent"] += 1
+                self._latencies.append(time.monotonic() - notification.enqueued_at)
+                logger.info(f"Уведомление отправлено пользователю {notification.chat_id}")
+                return
+
+            if notification.attempts >= self.max_attempts:
+                self.counters["failed"] += 1
+                logger.error(f"Уведомление пользователю {notification.chat_id} не доставлено за {notification.attempts} попыток")
+                return
+            self.counters["retried"] += 1
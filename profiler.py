@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+from config import (
+    PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS, PROFILE_OUTPUT_DIR, PROFILE_SIGNAL_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+def _frame_name(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _thread_stack(frame) -> list:
+    """Стек потока event loop от корутины задачи до текущей функции (без кадров самого asyncio)"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        # Ниже events.Handle._run - только цикл событий
+        if code.co_name == "_run" and code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+            break
+        stack.append(_frame_name(code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _await_stack(task: asyncio.Task) -> list:
+    """Цепочка await приостановленной задачи: где именно она ждет"""
+    stack = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "ag_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_frame_name(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    stack.append("[await]")
+    return stack
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер обработчиков бота и Web App
+
+    Отслеживаемые задачи (выборка PROFILE_SAMPLE_RATE или все во время окна) регистрируются
+    в track(). Отдельный поток раз в interval секунд снимает стек каждой такой задачи:
+    если она выполняется - стек потока event loop, если ждет - цепочку await. Стеки
+    агрегируются по имени обработчика и пишутся в формате collapsed stacks
+    (flamegraph.pl, speedscope, inferno). Пока профилирование выключено, track() не вызывается.
+    """
+
+    FLUSH_INTERVAL = 60
+
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 interval: float = PROFILE_INTERVAL_MS / 1000,
+                 output_dir: str = PROFILE_OUTPUT_DIR):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.output_dir = output_dir
+        self._window_until = 0.0
+        self._tasks: Dict[asyncio.Task, str] = {}  # задача -> имя обработчика
+        self._stacks: Dict[str, Counter] = {}  # имя обработчика -> Counter(стек -> число сэмплов)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def should_profile(self) -> bool:
+        """Профилировать ли очередной апдейт/запрос (дешевая проверка для горячего пути)"""
+        if self._window_until and time.monotonic() < self._window_until:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start_window(self, seconds: float) -> float:
+        """Профилировать все апдейты и запросы ближайшие seconds секунд; вернуть время окончания"""
+        self._window_until = time.monotonic() + seconds
+        logger.info(f"Окно профилирования открыто на {seconds:g} сек")
+        return self._window_until
+
+    def install_signal_handler(self, sig: int = signal.SIGUSR1, seconds: float = PROFILE_SIGNAL_SECONDS):
+        """Открывать окно профилирования по сигналу (kill -USR1 <pid>)"""
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, self.start_window, seconds)
+        except (NotImplementedError, RuntimeError, AttributeError, ValueError) as e:
+            logger.warning(f"Сигнал профилирования недоступен: {e}")
+
+    @contextmanager
+    def track(self, name: str):
+        """Сэмплировать текущую задачу, пока выполняется блок"""
+        task = asyncio.current_task()
+        if task is None:
+            yield
+            return
+        self._ensure_sampler()
+        self._tasks[task] = name
+        try:
+            yield
+        finally:
+            self._tasks.pop(task, None)
+
+    def _ensure_sampler(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        idle_since = None
+        while True:
+            time.sleep(self.interval)
+            if self._tasks:
+                idle_since = None
+                self._sample()
+            elif idle_since is None:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > 1 and time.monotonic() >= self._window_until and not self._tasks:
+                # Отслеживать нечего - поток завершается, результаты сбрасываются на диск
+                self.flush()
+                return
+            if time.monotonic() - self._flushed_at > self.FLUSH_INTERVAL:
+                self.flush()
+
+    def _sample(self):
+        try:
+            running = asyncio.current_task(self._loop)
+        except RuntimeError:
+            running = None
+        frame = sys._current_frames().get(self._loop_thread_id)
+        try:
+            tasks = list(self._tasks.items())
+        except RuntimeError:
+            return
+        with self._lock:
+            for task, name in tasks:
+                try:
+                    if task is running and frame is not None:
+                        stack = _thread_stack(frame)
+                    else:
+                        stack = _await_stack(task)
+                except Exception:
+                    # Задача меняется в потоке event loop прямо во время обхода - сэмпл пропускаем
+                    continue
+                self._stacks.setdefault(name, Counter())[";".join([name] + stack)] += 1
+
+    def flush(self) -> list:
+        """Записать накопленные стеки в <output_dir>/<обработчик>.<pid>.folded; вернуть пути файлов"""
+        self._flushed_at = time.monotonic()
+        with self._lock:
+            snapshot = {name: dict(stacks) for name, stacks in self._stacks.items()}
+        if not snapshot:
+            return []
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for name, stacks in snapshot.items():
+            safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name).strip("_") or "handler"
+            # pid в имени: у воркеров Web App общий каталог
+            path = os.path.join(self.output_dir, f"{safe_name}.{os.getpid()}.folded")
+            with open(path, "w") as f:
+                for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+        logger.info(f"Профиль записан: {', '.join(paths)}")
+        return paths
+
+profiler = SamplingProfiler()
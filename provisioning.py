@@ -0,0 +1,160 @@
+import asyncio
+import csv
+import io
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+from config import BASE_TARIFF_GB, BASE_TARIFF_DAYS, BASE_TARIFF_PRICE, BULK_CONCURRENCY, BULK_DB_BATCH_SIZE
+from database import create_users_bulk, get_users_by_telegram_ids
+
+logger = logging.getLogger(__name__)
+
+REPORT_FIELDS = ("telegram_id", "username", "status", "config", "error")
+
+def parse_telegram_ids(text: str) -> List[int]:
+    """telegram_id из текста (через пробел, запятую, точку с запятой или с новой строки)
+
+    Повторы убираются с сохранением порядка; нечисловые значения -> ValueError.
+    """
+    ids = []
+    seen = set()
+    for token in text.replace(",", " ").replace(";", " ").split():
+        telegram_id = int(token)
+        if telegram_id not in seen:
+            seen.add(telegram_id)
+            ids.append(telegram_id)
+    return ids
+
+class BulkProvisioner:
+    """Массовое создание ключей: Marzban с ограничением параллельности, БД пачками
+
+    Для каждого telegram_id: пользователь создается в Marzban (не более concurrency
+    одновременно), строки БД копятся и записываются пачками по db_batch_size одной
+    транзакцией вместе с покупкой тарифа (price, transaction_type), как при создании
+    ключа через Web App. Ошибка одного пользователя не останавливает
+    остальных - она попадает в отчет. Повторный запуск с тем же списком безопасен:
+    пользователи из БД отдаются как exists, а созданные в Marzban, но не записанные в БД
+    (сбой на середине), подхватываются как adopted.
+    """
+
+    def __init__(self, marzban, tariff_type: str = "base", data_limit_gb: int = BASE_TARIFF_GB,
+                 expire_days: int = BASE_TARIFF_DAYS, price: float = BASE_TARIFF_PRICE,
+                 transaction_type: str = "base_tariff", concurrency: int = BULK_CONCURRENCY,
+                 db_batch_size: int = BULK_DB_BATCH_SIZE):
+        self.marzban = marzban
+        self.tariff_type = tariff_type
+        self.data_limit_gb = data_limit_gb
+        self.expire_days = expire_days
+        self.price = price
+        self.transaction_type = transaction_type
+        self.concurrency = max(1, concurrency)
+        self.db_batch_size = max(1, db_batch_size)
+        self._pending_rows: List[tuple] = []
+        self._pending_results: List[Dict] = []
+        self._flush_lock = asyncio.Lock()
+
+    async def run(self, telegram_ids: Iterable[int],
+                  on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> List[Dict]:
+        """Создать ключи; вернуть отчет по каждому telegram_id в исходном порядке
+
+        Статусы: created, adopted (уже был в Marzban), exists (уже был в БД), failed.
+        on_progress(готово, всего) вызывается после каждого пользователя.
+        """
+        telegram_ids = list(dict.fromkeys(telegram_ids))
+        total = len(telegram_ids)
+        started = time.perf_counter()
+        existing = await get_users_by_telegram_ids(telegram_ids)
+        results = {telegram_id: {"telegram_id": telegram_id, "username": None, "status": None,
+                                 "config": None, "error": None} for telegram_id in telegram_ids}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = 0
+
+        async def provision(telegram_id):
+            nonlocal done
+            result = results[telegram_id]
+            try:
+                async with semaphore:
+                    db_user = existing.get(telegram_id)
+                    if db_user:
+                        result["username"] = db_user["username"]
+                        result["status"] = "exists"
+                        result["config"] = await self.marzban.get_user_config(db_user["username"])
+                    else:
+                        await self._create(result)
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            done += 1
+            if on_progress:
+                await on_progress(done, total)
+
+        await asyncio.gather(*(provision(telegram_id) for telegram_id in telegram_ids))
+        await self._flush()
+
+        report = [results[telegram_id] for telegram_id in telegram_ids]
+        counts = summarize(report)
+        logger.info(f"Массовое создание: {counts} за {time.perf_counter() - started:.1f} сек")
+        return report
+
+    async def _create(self, result: Dict):
+        telegram_id = result["telegram_id"]
+        username = f"user_{telegram_id}"
+        result["username"] = username
+        user = await self.marzban.create_user(
+            username=username, data_limit_gb=self.data_limit_gb, expire_days=self.expire_days
+        )
+        status = "created"
+        if not user:
+            # Уже есть в Marzban (например, прошлый запуск оборвался до записи в БД)
+            user = await self.marzban.adopt_user(username)
+            if not user:
+                result["status"] = "failed"
+                result["error"] = "Marzban не создал пользователя"
+                return
+            status = "adopted"
+        result["config"] = await self.marzban.get_user_config(username)
+        result["status"] = status
+        self._pending_rows.append((telegram_id, username, self.tariff_type, self.marzban.placement(username)))
+        self._pending_results.append(result)
+        if len(self._pending_rows) >= self.db_batch_size:
+            await self._flush()
+
+    async def _flush(self):
+        """Записать накопленных пользователей в БД одной транзакцией"""
+        async with self._flush_lock:
+            rows, self._pending_rows = self._pending_rows, []
+            batch_results, self._pending_results = self._pending_results, []
+            if not rows:
+                return
+            try:
+                inserted = await create_users_bulk(rows, transaction=(self.price, self.transaction_type))
+            except Exception as e:
+                logger.error(f"Ошибка записи пачки пользователей в БД ({len(rows)}): {e}")
+                for result in batch_results:
+                    result["status"] = "failed"
+                    result["error"] = f"Создан в Marzban, но не записан в БД: {e}"
+                return
+            for result in batch_results:
+                if result["telegram_id"] not in inserted:
+                    # Строку успел добавить кто-то другой (например, пользователь нажал /start)
+                    result["status"] = "exists"
+
+async def provision_users(marzban, telegram_ids: Iterable[int], **kwargs) -> List[Dict]:
+    """Создать ключи для списка telegram_id (параметры - как у BulkProvisioner)"""
+    on_progress = kwargs.pop("on_progress", None)
+    return await BulkProvisioner(marzban, **kwargs).run(telegram_ids, on_progress)
+
+def summarize(report: List[Dict]) -> Dict[str, int]:
+    """Число пользователей по статусам"""
+    counts: Dict[str, int] = {}
+    for result in report:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return counts
+
+def report_csv(report: List[Dict]) -> bytes:
+    """Отчет в CSV"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    writer.writerows(report)
+    return buffer.getvalue().encode()
@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from typing import Dict, Optional
+import qrcode
+from config import QR_WORKERS, QR_MEMORY_CACHE_BYTES, QR_DISK_CACHE_BYTES, QR_CACHE_DIR, QR_BOX_SIZE
+from metrics import REGISTRY, stats_samples
+
+logger = logging.getLogger(__name__)
+
+def render_png(text: str, box_size: int = QR_BOX_SIZE) -> bytes:
+    """PNG с QR-кодом text (выполняется в процессе пула)"""
+    code = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=4)
+    code.add_data(text)
+    code.make(fit=True)
+    buffer = io.BytesIO()
+    code.make_image().save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def content_key(text: str) -> str:
+    """Ключ кэша: sha256 содержимого QR-кода"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class QRCache:
+    """QR-коды ссылок: рендер в пуле процессов, кэш в памяти и на диске
+
+    Ключ - sha256 ссылки, поэтому одна и та же ссылка рендерится один раз, а после
+    смены ссылки старая картинка просто вытесняется. Оба уровня кэша - LRU с ограничением
+    по объему; на диске порядок определяется временем последнего доступа (mtime).
+    Параллельные запросы одной ссылки ждут один общий рендер.
+    """
+
+    def __init__(self, cache_dir: str = QR_CACHE_DIR, memory_bytes: int = QR_MEMORY_CACHE_BYTES,
+                 disk_bytes: int = QR_DISK_CACHE_BYTES, workers: int = QR_WORKERS):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.workers = max(1, workers)
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._disk_size: Optional[int] = None  # оценка объема каталога, считается при первой записи
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "renders": 0, "coalesced": 0, "errors": 0}
+
+    async def get_png(self, text: str) -> Optional[bytes]:
+        """PNG с QR-кодом text; None, если отрендерить не удалось"""
+        key = content_key(text)
+        png = self._memory.get(key)
+        if png is not None:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return png
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        png = None
+        try:
+            png = await self._load_or_render(key, text)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка при создании QR-кода: {e}")
+        finally:
+            # Ожидающие получают результат, даже если этот запрос отменили
+            self._pending.pop(key, None)
+            future.set_result(png)
+        return png
+
+    async def _load_or_render(self, key: str, text: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self.cache_dir, f"{key}.png")
+        png = await loop.run_in_executor(None, self._read_disk, path)
+        if png is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            if self._pool is None:
+                # forkserver: не форкаем процесс с потоками aiosqlite и открытыми сокетами
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver")
+                )
+            png = await loop.run_in_executor(self._pool, render_png, text)
+            self.stats["renders"] += 1
+            await loop.run_in_executor(None, self._write_disk, path, png)
+        self._remember(key, png)
+        return png
+
+    def _remember(self, key: str, png: bytes):
+        self._memory[key] = png
+        self._memory_size += len(png)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    @staticmethod
+    def _read_disk(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+        except FileNotFoundError:
+            return None
+        # Отметка использования для LRU на диске
+        os.utime(path)
+        return png
+
+    def _write_disk(self, path: str, png: bytes):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if self._disk_size is None:
+            self._disk_size = self._scan_disk()[1]
+        # Через временный файл: воркеры Web App делят каталог и не должны читать недописанный PNG
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+        self._disk_size += len(png)
+        if self._disk_size > self.disk_bytes:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        """(список (mtime, размер, путь), общий объем) PNG в каталоге кэша"""
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".png"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        return files, total
+
+    def _evict_disk(self):
+        """Удалять давно не запрошенные файлы, пока объем не станет меньше 90% лимита"""
+        files, total = self._scan_disk()
+        files.sort()
+        target = self.disk_bytes * 0.9
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._disk_size = total
+        if removed:
+            logger.info(f"Кэш QR-кодов: удалено {removed} файлов, объем {total / 1024 / 1024:.1f} МБ")
+
+    def close(self):
+        """Остановить пул процессов рендера"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+qr_cache = QRCache()
+
+REGISTRY.callback(
+    "qr_cache_events_total", "Запросы QR-кодов: попадания в кэш памяти/диска, рендеры", ["event"], "counter",
+    lambda: stats_samples(qr_cache.stats)
+)
+REGISTRY.callback(
+    "qr_cache_memory_bytes", "Объем кэша QR-кодов в памяти", (), "gauge",
+    lambda: [((), qr_cache._memory_size)]
+)
@@ -1,128 +1,331 @@
+import asyncio
+import json
 import logging
+import time
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from database import get_all_users, update_last_check
+from database import (
+    count_users, get_users_by_usernames, update_last_check_bulk, update_notification_state_bulk,
+    iter_user_snapshot_batches
+)
+from config import (
+    LAST_CHECK_BATCH_SIZE, LIMIT_RENOTIFY_HOURS, LIMIT_SWEEP_INTERVAL_MINUTES,
+    HOT_CHECK_INTERVAL_SECONDS, HOT_CHECK_CONCURRENCY, HOT_CHECK_MAX_PER_RUN,
+    SNAPSHOT_PERSIST, SNAPSHOT_PERSIST_MAX_AGE_HOURS
+)
 from marzban_api import MarzbanAPI
+from notifier import NotificationDispatcher
+from usage_tracker import UsageTracker
+from metrics import REGISTRY, DURATION_BUCKETS
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 logger = logging.getLogger(__name__)
 
-# Глобальные переменные для бота и Marzban API
+# Глобальные переменные для бота, Marzban API и диспетчера уведомлений
 bot_instance = None
 marzban_instance = None
+notifier_instance = None
 
-def set_bot_and_marzban(bot: Bot, marzban: MarzbanAPI):
-    """Установить экземпляры бота и Marzban API"""
-    global bot_instance, marzban_instance
+# Скорость расхода трафика между проверками
+usage_tracker = UsageTracker()
+
+CHECK_SECONDS = REGISTRY.histogram(
+    "limit_check_duration_seconds", "Длительность проверок лимитов", ["task"], buckets=DURATION_BUCKETS
+)
+CHECK_USERS = REGISTRY.counter(
+    "limit_check_users_total", "Пользователи, обработанные проверками лимитов", ["task", "result"]
+)
+LIMIT_NOTIFICATIONS = REGISTRY.counter(
+    "limit_notifications_total", "Решения об уведомлениях о превышении лимита", ["outcome"]
+)
+LAST_SWEEP_LIMITED = REGISTRY.gauge(
+    "limit_sweep_last_limited_users", "Пользователей в статусе limited по последнему полному проходу"
+)
+REGISTRY.callback(
+    "usage_tracker_users", "Пользователи в трекере расхода трафика", ["state"], "gauge",
+    lambda: [((key,), value) for key, value in usage_tracker.stats().items()]
+)
+
+def set_bot_and_marzban(bot: Bot, marzban: MarzbanAPI, notifier: NotificationDispatcher):
+    """Установить экземпляры бота, Marzban API и диспетчера уведомлений"""
+    global bot_instance, marzban_instance, notifier_instance
     bot_instance = bot
     marzban_instance = marzban
+    notifier_instance = notifier
+
+async def seed_usage_tracker() -> int:
+    """Первые наблюдения трекера расхода из read-модели в SQLite
+    
+    Вызывается процессом, который запускает планировщик. После перезапуска первый полный
+    проход уже сравнивает used_traffic с сохраненным и оценивает скорость, а пользователи
+    у лимита сразу попадают во внеочередные проверки.
+    """
+    seeded = 0
+    if not SNAPSHOT_PERSIST:
+        return seeded
+    try:
+        async for rows in iter_user_snapshot_batches(time.time() - SNAPSHOT_PERSIST_MAX_AGE_HOURS * 3600):
+            for username, fetched_at, data, _ in rows:
+                usage_tracker.observe(username, json.loads(data), now=fetched_at)
+            seeded += len(rows)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении read-модели для трекера расхода: {e}")
+    if seeded:
+        logger.info(f"Трекер расхода заполнен из сохраненной read-модели: {usage_tracker.stats()}")
+    return seeded
+
+def _should_notify(db_user: dict, used_traffic: int, now: datetime) -> bool:
+    """Нужно ли уведомлять пользователя со статусом limited
+    
+    Уведомляем при переходе в limited (в том числе после сброса статистики)
+    и повторно не чаще, чем раз в LIMIT_RENOTIFY_HOURS.
+    """
+    if db_user.get("notified_status") != "limited" or not db_user.get("notified_at"):
+        return True
+    
+    notified_used = db_user.get("notified_used_traffic")
+    if notified_used is not None and used_traffic < notified_used:
+        return True
+    
+    if LIMIT_RENOTIFY_HOURS <= 0:
+        return False
+    notified_at = datetime.fromisoformat(str(db_user["notified_at"]))
+    return now - notified_at >= timedelta(hours=LIMIT_RENOTIFY_HOURS)
+
+def _enqueue_limit_notification(telegram_id: int, username: str, marzban_user: dict) -> bool:
+    """Поставить в очередь уведомление о превышении лимита"""
+    logger.info(f"Пользователь {username} (ID: {telegram_id}) превысил лимит")
+    
+    # Отправляем уведомление с выбором
+    try:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text="💰 Купить +100 ГБ за 99₽",
+                    callback_data=f"buy_extra_{telegram_id}"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    text="🐌 Включить бесплатный режим (2 Мбит/с)",
+                    callback_data=f"enable_free_{telegram_id}"
+                )
+            ]
+        ])
+        
+        used_gb = marzban_user.get("used_traffic", 0) / (1024**3)
+        limit_gb = marzban_user.get("data_limit", 0) / (1024**3) if marzban_user.get("data_limit") else "∞"
+        
+        message_text = (
+            "⚠️ *Трафик закончился!*\n\n"
+            f"Использовано: {used_gb:.2f} GB / {limit_gb} GB\n\n"
+            "У тебя есть два пути:\n\n"
+            "💰 *Купить еще 100 ГБ за 99₽* (скорость 1 Гбит/с)\n\n"
+            "🐌 *Включить 'Бесплатный режим'* до конца месяца (скорость будет 2 Мбит/с)"
+        )
+        
+        # Отправкой занимается диспетчер, проверка не ждет Telegram
+        return notifier_instance.enqueue(
+            telegram_id,
+            message_text,
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+        
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке уведомления пользователю {telegram_id}: {e}")
+        return False
+
+class _CheckBatch:
+    """Проверка пачки пользователей: уведомления, счетчики и отложенные записи в БД"""
+    
+    def __init__(self):
+        self.now = datetime.now()
+        self.checked = 0
+        self.limited = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self._checked_ids = []
+        self._notification_states = []
+    
+    async def check(self, db_user: dict, marzban_user: dict):
+        """Проверить одного пользователя по свежим данным Marzban"""
+        telegram_id = db_user["telegram_id"]
+        username = db_user["username"]
+        
+        status = marzban_user.get("status", "unknown")
+        used_traffic = marzban_user.get("used_traffic", 0)
+        
+        self.checked += 1
+        usage_tracker.observe(username, marzban_user)
+        
+        # Проверяем, если статус limited и пользователь еще не был уведомлен
+        if status == "limited":
+            self.limited += 1
+            
+            if not _should_notify(db_user, used_traffic, self.now):
+                self.skipped += 1
+            elif _enqueue_limit_notification(telegram_id, username, marzban_user):
+                self.sent += 1
+                self._notification_states.append((telegram_id, "limited", self.now, used_traffic))
+            else:
+                self.failed += 1
+        
+        elif db_user.get("notified_status") != status:
+            # Запоминаем выход из limited, чтобы следующий лимит считался новым переходом
+            self._notification_states.append((telegram_id, status, db_user.get("notified_at"), used_traffic))
+        
+        # Время последней проверки записываем пачками, а не по одному
+        self._checked_ids.append(telegram_id)
+        if len(self._checked_ids) >= LAST_CHECK_BATCH_SIZE:
+            await self.flush()
+    
+    async def flush(self):
+        """Записать накопленные last_check и состояния уведомлений"""
+        await update_last_check_bulk(self._checked_ids)
+        await update_notification_state_bulk(self._notification_states)
+        self._checked_ids = []
+        self._notification_states = []
+    
+    def record_metrics(self, task: str, started: float):
+        """Учесть итоги проверки в метриках"""
+        CHECK_SECONDS.labels(task).observe(time.perf_counter() - started)
+        CHECK_USERS.labels(task, "checked").inc(self.checked)
+        CHECK_USERS.labels(task, "limited").inc(self.limited)
+        LIMIT_NOTIFICATIONS.labels("queued").inc(self.sent)
+        LIMIT_NOTIFICATIONS.labels("skipped").inc(self.skipped)
+        LIMIT_NOTIFICATIONS.labels("not_queued").inc(self.failed)
+
+def _is_ready() -> bool:
+    if not bot_instance or not marzban_instance or not notifier_instance:
+        logger.error("Бот, Marzban API или диспетчер уведомлений не инициализированы")
+        return False
+    return True
 
 async def check_limits_task():
     """Проверка лимитов всех пользователей"""
-    if not bot_instance or not marzban_instance:
-        logger.error("Бот или Marzban API не инициализированы")
+    if not _is_ready():
         return
     
     logger.info("Начинаю проверку лимитов пользователей...")
+    started = time.perf_counter()
     
-    # Получаем всех пользователей из БД
-    db_users = await get_all_users()
+    # Сколько пользователей в БД
+    db_total = await count_users()
     
-    if not db_users:
+    if not db_total:
         logger.info("Нет пользователей для проверки")
         return
     
-    # Получаем всех пользователей из Marzban
-    marzban_users_data = await marzban_instance.get_users()
+    batch = _CheckBatch()
+    pages_count = 0
     
-    if not marzban_users_data or not marzban_users_data.get("users"):
+    # Пользователи Marzban приходят постранично: в памяти одна страница, а не вся панель
+    async for marzban_page in marzban_instance.iter_users_pages():
+        pages_count += 1
+        fetched_at = time.time()
+        swept = []
+        db_users = await get_users_by_usernames(user.get("username") for user in marzban_page)
+        
+        for marzban_user in marzban_page:
+            db_user = db_users.get(marzban_user.get("username"))
+            
+            # Пользователь панели, созданный не ботом
+            if not db_user:
+                continue
+            
+            swept.append(marzban_user)
+            await batch.check(db_user, marzban_user)
+        
+        # Read-модель для обработчиков статуса всех процессов - страница за страницей
+        await marzban_instance.snapshot.save_swept(swept, fetched_at)
+    
+    await batch.flush()
+    batch.record_metrics("check_limits", started)
+    await marzban_instance.snapshot.prune()
+    
+    if not pages_count:
         logger.warning("Не удалось получить пользователей из Marzban")
         return
     
-    # Создаем словарь для быстрого поиска по username
-    marzban_users = {user.get("username"): user for user in marzban_users_data["users"]}
+    LAST_SWEEP_LIMITED.set(batch.limited)
     
-    limited_count = 0
+    if batch.checked < db_total:
+        logger.warning(f"Не найдено в Marzban пользователей из БД: {db_total - batch.checked}")
     
-    # Проверяем каждого пользователя из БД
-    for db_user in db_users:
-        telegram_id = db_user["telegram_id"]
-        username = db_user["username"]
-        
-        # Получаем данные пользователя из Marzban
-        marzban_user = marzban_users.get(username)
-        
-        if not marzban_user:
-            logger.warning(f"Пользователь {username} не найден в Marzban")
+    logger.info(
+        f"Проверка завершена. Найдено пользователей с превышением лимита: {batch.limited}, "
+        f"уведомлений в очереди: {batch.sent}, пропущено повторных: {batch.skipped}"
+    )
+    logger.info(f"Диспетчер уведомлений: {notifier_instance.stats()}, трекер: {usage_tracker.stats()}")
+
+async def check_hot_users_task():
+    """Внеочередная проверка пользователей, которые по прогнозу скоро упрутся в лимит"""
+    if not _is_ready():
+        return
+    
+    due = usage_tracker.pop_due(limit=HOT_CHECK_MAX_PER_RUN)
+    if not due:
+        return
+    started = time.perf_counter()
+    
+    db_users = await get_users_by_usernames(due)
+    semaphore = asyncio.Semaphore(HOT_CHECK_CONCURRENCY)
+    
+    async def fetch(username):
+        async with semaphore:
+            return await marzban_instance.get_user(username, use_cache=False)
+    
+    marzban_users = await asyncio.gather(*(fetch(username) for username in due), return_exceptions=True)
+    
+    batch = _CheckBatch()
+    for username, marzban_user in zip(due, marzban_users):
+        if isinstance(marzban_user, Exception):
+            logger.warning(f"Ошибка при внеочередной проверке {username}: {marzban_user}")
             continue
-        
-        status = marzban_user.get("status", "unknown")
-        
-        # Проверяем, если статус limited и пользователь еще не был уведомлен
-        if status == "limited":
-            limited_count += 1
-            logger.info(f"Пользователь {username} (ID: {telegram_id}) превысил лимит")
-            
-            # Отправляем уведомление с выбором
-            try:
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text="💰 Купить +100 ГБ за 99₽",
-                            callback_data=f"buy_extra_{telegram_id}"
-                        )
-                    ],
-                    [
-                        InlineKeyboardButton(
-                            text="🐌 Включить бесплатный режим (2 Мбит/с)",
-                            callback_data=f"enable_free_{telegram_id}"
-                        )
-                    ]
-                ])
-                
-                used_gb = marzban_user.get("used_traffic", 0) / (1024**3)
-                limit_gb = marzban_user.get("data_limit", 0) / (1024**3) if marzban_user.get("data_limit") else "∞"
-                
-                message_text = (
-                    "⚠️ *Трафик закончился!*\n\n"
-                    f"Использовано: {used_gb:.2f} GB / {limit_gb} GB\n\n"
-                    "У тебя есть два пути:\n\n"
-                    "💰 *Купить еще 100 ГБ за 99₽* (скорость 1 Гбит/с)\n\n"
-                    "🐌 *Включить 'Бесплатный режим'* до конца месяца (скорость будет 2 Мбит/с)"
-                )
-                
-                await bot_instance.send_message(
-                    chat_id=telegram_id,
-                    text=message_text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"Уведомление отправлено пользователю {telegram_id}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления пользователю {telegram_id}: {e}")
-        
-        # Обновляем время последней проверки
-        await update_last_check(telegram_id)
+        db_user = db_users.get(username)
+        if not marzban_user or not db_user:
+            usage_tracker.forget(username)
+            continue
+        await batch.check(db_user, marzban_user)
+    await batch.flush()
+    batch.record_metrics("check_hot_users", started)
     
-    logger.info(f"Проверка завершена. Найдено пользователей с превышением лимита: {limited_count}")
+    logger.info(
+        f"Внеочередная проверка: {batch.checked} пользователей у лимита, "
+        f"превысили: {batch.limited}, уведомлений в очереди: {batch.sent}"
+    )
 
 def start_scheduler():
-    """Запуск планировщика для проверки лимитов каждые 5 минут"""
+    """Запуск планировщика: полный проход по лимитам и частые проверки пользователей у лимита"""
     scheduler = AsyncIOScheduler()
     
-    # Запускаем проверку каждые 5 минут
+    # Полный проход по всем пользователям
     scheduler.add_job(
         check_limits_task,
         trigger="interval",
-        minutes=5,
+        minutes=LIMIT_SWEEP_INTERVAL_MINUTES,
         id="check_limits",
         replace_existing=True
     )
     
+    # Пользователи, которые по прогнозу скоро упрутся в лимит
+    scheduler.add_job(
+        check_hot_users_task,
+        trigger="interval",
+        seconds=HOT_CHECK_INTERVAL_SECONDS,
+        id="check_hot_users",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    
     scheduler.start()
-    logger.info("Планировщик запущен. Проверка лимитов каждые 5 минут")
+    logger.info(
+        f"Планировщик запущен. Проверка лимитов каждые {LIMIT_SWEEP_INTERVAL_MINUTES:g} мин, "
+        f"пользователей у лимита - каждые {HOT_CHECK_INTERVAL_SECONDS:g} сек"
+    )
     
     return scheduler
-
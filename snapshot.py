@@ -0,0 +1,96 @@
+import json
+import logging
+import time
+from typing import Iterable, Optional
+from config import SNAPSHOT_MAX_AGE_SECONDS, SNAPSHOT_PERSIST, SNAPSHOT_PERSIST_MAX_AGE_HOURS, MARZBAN_USER_CACHE_TTL
+from database import save_user_snapshot, get_user_snapshot, prune_user_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Поля пользователя Marzban, которые нужны экранам статуса (ссылки всегда берутся из панели)
+SNAPSHOT_FIELDS = ("username", "status", "used_traffic", "data_limit", "expire")
+
+def _compact(user: dict) -> str:
+    return json.dumps({field: user[field] for field in SNAPSHOT_FIELDS if field in user}, separators=(",", ":"))
+
+class UserSnapshot:
+    """Read-модель пользователей Marzban: таблица user_snapshot в общей SQLite
+
+    Полный проход планировщика записывает данные постранично (swept), а собственные
+    записи любого процесса (покупка, бесплатный режим) сразу заменяют строку пользователя
+    более свежей. Поэтому бот, воркеры Web App и не-лидеры webhook читают одни и те же
+    данные прохода, не держа всю панель в памяти. Строки прохода отдаются, пока они
+    не старше max_age, строки собственных записей - не дольше point_max_age: после
+    этого обработчики идут в Marzban за актуальным состоянием.
+    """
+
+    def __init__(self, max_age: float = SNAPSHOT_MAX_AGE_SECONDS, point_max_age: float = MARZBAN_USER_CACHE_TTL):
+        self.max_age = max_age
+        self.point_max_age = point_max_age
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "errors": 0}
+
+    async def get(self, username: str, max_age: Optional[float] = None) -> Optional[dict]:
+        """Данные пользователя, если они не старше max_age секунд
+
+        По умолчанию max_age - self.max_age; строки не из прохода отдаются не дольше point_max_age.
+        """
+        if not SNAPSHOT_PERSIST:
+            return None
+        try:
+            row = await get_user_snapshot(username)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка при чтении read-модели {username}: {e}")
+            return None
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        fetched_at, data, swept = row
+        max_age = self.max_age if max_age is None else max_age
+        if not swept:
+            max_age = min(max_age, self.point_max_age)
+        if time.time() - fetched_at > max_age:
+            self.stats["stale"] += 1
+            return None
+        self.stats["hits"] += 1
+        return json.loads(data)
+
+    async def save_swept(self, users: Iterable[dict], fetched_at: Optional[float] = None) -> int:
+        """Записать страницу полного прохода"""
+        if not SNAPSHOT_PERSIST:
+            return 0
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        entries = [(user["username"], fetched_at, _compact(user), 1) for user in users if user.get("username")]
+        try:
+            return await save_user_snapshot(entries)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении read-модели ({len(entries)} пользователей): {e}")
+            return 0
+
+    async def record(self, user: dict):
+        """Данные после собственной записи в Marzban"""
+        if not SNAPSHOT_PERSIST or not user.get("username"):
+            return
+        try:
+            await save_user_snapshot([(user["username"], time.time(), _compact(user), 0)])
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении read-модели {user['username']}: {e}")
+
+    async def discard(self, username: str):
+        """Забыть пользователя (удален или результат записи неизвестен)"""
+        if not SNAPSHOT_PERSIST:
+            return
+        try:
+            await save_user_snapshot([], deleted=[username])
+        except Exception as e:
+            logger.error(f"Ошибка при удалении {username} из read-модели: {e}")
+
+    async def prune(self) -> int:
+        """Удалить строки старше SNAPSHOT_PERSIST_MAX_AGE_HOURS (пользователи, пропавшие из панели)"""
+        if not SNAPSHOT_PERSIST:
+            return 0
+        try:
+            return await prune_user_snapshot(time.time() - SNAPSHOT_PERSIST_MAX_AGE_HOURS * 3600)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке read-модели: {e}")
+            return 0
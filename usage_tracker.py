@@ -0,0 +1,102 @@
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+from config import (
+    LIMIT_SWEEP_INTERVAL_MINUTES, HOT_CHECK_MIN_INTERVAL_SECONDS,
+    HOT_CHECK_SAFETY_FACTOR, HOT_CHECK_REMAINING_FRACTION
+)
+
+class UsageTracker:
+    """Скорость расхода трафика по пользователям и расписание внеочередных проверок
+
+    По двум последовательным наблюдениям used_traffic оценивается скорость (EWMA)
+    и момент, когда пользователь упрется в data_limit. Тех, кто может упереться
+    раньше следующего полного прохода, нужно проверять отдельно и чаще.
+    """
+
+    EWMA_ALPHA = 0.5
+
+    def __init__(self, min_interval: float = HOT_CHECK_MIN_INTERVAL_SECONDS,
+                 horizon: float = LIMIT_SWEEP_INTERVAL_MINUTES * 60,
+                 safety_factor: float = HOT_CHECK_SAFETY_FACTOR,
+                 remaining_fraction: float = HOT_CHECK_REMAINING_FRACTION):
+        self.min_interval = min_interval
+        self.horizon = horizon
+        self.safety_factor = safety_factor
+        self.remaining_fraction = remaining_fraction
+        self._usage: Dict[str, Tuple[int, float, float]] = {}  # username -> (used_traffic, observed_at, bytes/сек)
+        self._scheduled: Dict[str, float] = {}  # username -> время внеочередной проверки
+        self._heap: List[Tuple[float, str]] = []
+
+    def observe(self, username: str, marzban_user: dict, now: Optional[float] = None) -> Optional[float]:
+        """Учесть свежие данные пользователя; вернуть время внеочередной проверки или None"""
+        now = now if now is not None else time.time()
+        data_limit = marzban_user.get("data_limit") or 0
+        used = marzban_user.get("used_traffic") or 0
+
+        # Безлимитным и уже не активным внеочередные проверки не нужны
+        if marzban_user.get("status") != "active" or not data_limit:
+            self.forget(username)
+            return None
+
+        rate = 0.0
+        previous = self._usage.get(username)
+        if previous:
+            prev_used, prev_at, prev_rate = previous
+            elapsed = now - prev_at
+            if used < prev_used:
+                # Статистику сбросили - начинаем заново
+                rate = 0.0
+            elif elapsed > 0:
+                rate = self.EWMA_ALPHA * (used - prev_used) / elapsed + (1 - self.EWMA_ALPHA) * prev_rate
+            else:
+                rate = prev_rate
+        self._usage[username] = (used, now, rate)
+
+        remaining = data_limit - used
+        if rate <= 0:
+            # Трафик не расходуется (или скорость еще неизвестна) - хватит полного прохода,
+            # даже если до лимита осталось совсем немного
+            delay = float("inf")
+        elif remaining <= data_limit * self.remaining_fraction:
+            delay = self.min_interval
+        else:
+            delay = max(self.min_interval, remaining / rate * self.safety_factor)
+
+        # До следующего полного прохода не успеет - отдельная проверка не нужна
+        if delay >= self.horizon:
+            self._scheduled.pop(username, None)
+            return None
+
+        check_at = now + delay
+        self._scheduled[username] = check_at
+        heapq.heappush(self._heap, (check_at, username))
+        self._compact()
+        return check_at
+
+    def forget(self, username: str):
+        """Перестать отслеживать пользователя"""
+        self._usage.pop(username, None)
+        self._scheduled.pop(username, None)
+
+    def pop_due(self, now: Optional[float] = None, limit: Optional[int] = None) -> List[str]:
+        """Забрать пользователей, которых пора проверить (самые срочные первыми)"""
+        now = now if now is not None else time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            check_at, username = heapq.heappop(self._heap)
+            # Устаревшая запись кучи: расписание пользователя с тех пор пересчитано
+            if self._scheduled.get(username) != check_at:
+                continue
+            del self._scheduled[username]
+            due.append(username)
+        return due
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._usage), "scheduled": len(self._scheduled)}
+
+    def _compact(self):
+        """Перестроить кучу, если в ней накопилось много устаревших записей"""
+        if len(self._heap) > 2 * len(self._scheduled) + 1000:
+            self._heap = [(check_at, username) for username, check_at in self._scheduled.items()]
+            heapq.heapify(self._heap)
@@ -13,10 +13,53 @@ if (!telegramId) {
     showError('Не удалось получить данные пользователя');
 }
 
+// GET с кэшем по ETag: при 304 отдаем сохраненное тело, пока не истек max-age - не ходим в сеть
+async function cachedFetch(url) {
+    const key = `api-cache:${url}`;
+    let cached = null;
+    try {
+        cached = JSON.parse(localStorage.getItem(key));
+    } catch (e) {
+        cached = null;
+    }
+    
+    const fromCache = () => new Response(cached.body, {
+        status: 200,
+        headers: { 'Content-Type': 'application/json' }
+    });
+    
+    if (cached && cached.expiresAt > Date.now()) {
+        return fromCache();
+    }
+    
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+    const response = await fetch(url, { headers, cache: 'no-store' });
+    
+    if (response.status === 304 && cached) {
+        return fromCache();
+    }
+    
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) {
+        const maxAge = /max-age=(\d+)/.exec(response.headers.get('Cache-Control') || '');
+        const body = await response.clone().text();
+        try {
+            localStorage.setItem(key, JSON.stringify({
+                etag,
+                body,
+                expiresAt: maxAge ? Date.now() + Number(maxAge[1]) * 1000 : 0
+            }));
+        } catch (e) {
+            // Хранилище недоступно или переполнено - работаем без кэша
+        }
+    }
+    return response;
+}
+
 // Загрузка тарифов
 async function loadTariffs() {
     try {
-        const response = await fetch(`${API_URL}/tariffs`);
+        const response = await cachedFetch(`${API_URL}/tariffs`);
         const data = await response.json();
         
         document.getElementById('base-gb').textContent = data.base.gb;
@@ -32,7 +75,7 @@ async function loadTariffs() {
 // Проверка статуса пользователя
 async function checkUserStatus() {
     try {
-        const response = await fetch(`${API_URL}/user/status?telegram_id=${telegramId}`);
+        const response = await cachedFetch(`${API_URL}/user/status?telegram_id=${telegramId}`);
         
         if (response.status === 404) {
             // Пользователь не найден - показываем экран покупки
@@ -143,7 +186,7 @@ async function getConfig() {
     try {
         tg.showAlert('⏳ Загружаю конфигурацию...');
         
-        const response = await fetch(`${API_URL}/user/config?telegram_id=${telegramId}`);
+        const response = await cachedFetch(`${API_URL}/user/config?telegram_id=${telegramId}`);
         
         if (!response.ok) {
             throw new Error('Ошибка при получении конфигурации');
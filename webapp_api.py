@@ -1,49 +1,129 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import asyncio
+from aiohttp import web
+import hashlib
+import hmac
+import json
 import logging
+import multiprocessing
+import time
 from datetime import datetime, timedelta
 from config import (
     TELEGRAM_BOT_TOKEN, BASE_TARIFF_GB, BASE_TARIFF_DAYS, BASE_TARIFF_PRICE,
-    EXTRA_GB_AMOUNT, EXTRA_GB_PRICE, FREE_MODE_SPEED_MBPS
+    EXTRA_GB_AMOUNT, EXTRA_GB_PRICE, FREE_MODE_SPEED_MBPS,
+    WEBAPP_HOST, WEBAPP_PORT, WEBAPP_WORKERS, ADMIN_API_TOKEN, BULK_MAX_USERS
 )
 from marzban_api import MarzbanAPI
+from metrics import REGISTRY, add_public_metrics_route
+from profiler import profiler
+from export import EXPORTS, FORMATS, iter_export
+from qr import qr_cache, content_key
+from provisioning import provision_users, summarize
 from database import (
-    get_user_by_telegram_id, create_user as db_create_user,
+    init_db, close_db, get_user_by_telegram_id, create_user as db_create_user,
     update_user_tariff, enable_free_mode, add_transaction
 )
 
-app = Flask(__name__)
-CORS(app)  # Разрешаем CORS для Telegram Web App
+routes = web.RouteTableDef()
 
+# Один экземпляр на процесс: пул соединений Marzban и SQLite живут вместе с event loop приложения
 marzban = MarzbanAPI()
 
-def run_async(coro):
-    """Запуск async функции в синхронном контексте"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "webapp_request_duration_seconds", "Время обработки запросов Web App API", ["method", "route", "status"]
+)
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Время обработки по шаблону маршрута (не по фактическому пути)"""
+    started = time.perf_counter()
+    status = 500
     try:
-        return loop.run_until_complete(coro)
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
     finally:
-        loop.close()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(request.method, route, status).observe(time.perf_counter() - started)
+
+@web.middleware
+async def profiling_middleware(request, handler):
+    """Профилировать выборку запросов, стеки группируются по шаблону маршрута"""
+    if not profiler.should_profile():
+        return await handler(request)
+    resource = request.match_info.route.resource
+    with profiler.track(resource.canonical if resource is not None else "unmatched"):
+        return await handler(request)
+
+# Сколько секунд браузер может не повторять preflight (OPTIONS) для того же запроса
+CORS_PREFLIGHT_MAX_AGE = 86400
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Разрешаем CORS для Telegram Web App"""
+    if request.method == "OPTIONS":
+        response = web.Response()
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get(
+            "Access-Control-Request-Headers", "Content-Type"
+        )
+        # If-None-Match делает GET "непростым": без кэша preflight каждый условный запрос
+        # стоил бы лишнего OPTIONS (Chromium ограничивает срок 2 часами, Firefox - сутками)
+        response.headers["Access-Control-Max-Age"] = str(CORS_PREFLIGHT_MAX_AGE)
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    # ETag нужен app.js для условных запросов
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
+    return response
+
+# Политики кэширования по эндпоинтам
+CACHE_TARIFFS = "public, max-age=3600"
+CACHE_PRIVATE_REVALIDATE = "private, no-cache"
+
+def _etag_matches(request, etag):
+    """Совпадает ли ETag с одним из значений If-None-Match (сравнение слабое)"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+def conditional_json_response(request, payload, cache_control):
+    """JSON-ответ с ETag по хэшу содержимого; 304 без тела, если клиент прислал тот же ETag"""
+    body = json.dumps(payload)
+    etag = f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if _etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=body, content_type="application/json", headers=headers)
 
-@app.route('/api/user/status', methods=['GET'])
-def get_user_status():
+@routes.get('/api/user/status')
+async def get_user_status(request):
     """Получить статус пользователя"""
     try:
-        telegram_id = int(request.args.get('telegram_id'))
+        telegram_id = int(request.query.get('telegram_id'))
         
         # Получаем пользователя из БД
-        user = run_async(get_user_by_telegram_id(telegram_id))
+        user = await get_user_by_telegram_id(telegram_id)
         if not user:
-            return jsonify({"error": "Пользователь не найден"}), 404
+            return web.json_response({"error": "Пользователь не найден"}, status=404)
         
         username = user["username"]
         
-        # Получаем данные из Marzban
-        marzban_user = run_async(marzban.get_user(username))
+        # Данные из последнего прохода планировщика или из Marzban, если они устарели
+        marzban_user = await marzban.get_user_status(username)
         if not marzban_user:
-            return jsonify({"error": "Пользователь не найден в Marzban"}), 404
+            return web.json_response({"error": "Пользователь не найден в Marzban"}, status=404)
         
         used_gb = marzban_user.get("used_traffic", 0) / (1024**3)
         limit_gb = marzban_user.get("data_limit", 0) / (1024**3) if marzban_user.get("data_limit") else None
@@ -56,7 +136,7 @@ def get_user_status():
         
         free_mode = user.get("free_mode_enabled", 0)
         
-        return jsonify({
+        return conditional_json_response(request, {
             "username": username,
             "status": status,
             "used_gb": round(used_gb, 2),
@@ -64,64 +144,92 @@ def get_user_status():
             "expire_date": expire_date,
             "free_mode": bool(free_mode),
             "tariff_type": user.get("tariff_type", "base")
-        })
+        }, CACHE_PRIVATE_REVALIDATE)
     except Exception as e:
         logging.error(f"Error in get_user_status: {e}")
-        return jsonify({"error": str(e)}), 500
+        return web.json_response({"error": str(e)}, status=500)
 
-@app.route('/api/user/config', methods=['GET'])
-def get_user_config():
+@routes.get('/api/user/config')
+async def get_user_config(request):
     """Получить конфигурацию пользователя"""
     try:
-        telegram_id = int(request.args.get('telegram_id'))
+        telegram_id = int(request.query.get('telegram_id'))
         
-        user = run_async(get_user_by_telegram_id(telegram_id))
+        user = await get_user_by_telegram_id(telegram_id)
         if not user:
-            return jsonify({"error": "Пользователь не найден"}), 404
+            return web.json_response({"error": "Пользователь не найден"}, status=404)
         
         username = user["username"]
-        config = run_async(marzban.get_user_config(username))
+        config = await marzban.get_user_config(username)
         
         if not config:
-            return jsonify({"error": "Не удалось получить конфигурацию"}), 404
+            return web.json_response({"error": "Не удалось получить конфигурацию"}, status=404)
         
-        return jsonify({"config": config})
+        return conditional_json_response(request, {"config": config}, CACHE_PRIVATE_REVALIDATE)
     except Exception as e:
         logging.error(f"Error in get_user_config: {e}")
-        return jsonify({"error": str(e)}), 500
+        return web.json_response({"error": str(e)}, status=500)
+
+@routes.get('/api/user/config/qr')
+async def get_user_config_qr(request):
+    """QR-код конфигурации пользователя (PNG)"""
+    try:
+        telegram_id = int(request.query.get('telegram_id'))
+        
+        user = await get_user_by_telegram_id(telegram_id)
+        if not user:
+            return web.json_response({"error": "Пользователь не найден"}, status=404)
+        
+        config = await marzban.get_user_config(user["username"])
+        if not config:
+            return web.json_response({"error": "Не удалось получить конфигурацию"}, status=404)
+        
+        # Картинка определяется ссылкой: ETag - ее хэш, без рендера для 304
+        etag = f'"{content_key(config)[:32]}"'
+        headers = {"ETag": etag, "Cache-Control": CACHE_PRIVATE_REVALIDATE}
+        if _etag_matches(request, etag):
+            return web.Response(status=304, headers=headers)
+        
+        png = await qr_cache.get_png(config)
+        if not png:
+            return web.json_response({"error": "Не удалось создать QR-код"}, status=500)
+        return web.Response(body=png, content_type="image/png", headers=headers)
+    except Exception as e:
+        logging.error(f"Error in get_user_config_qr: {e}")
+        return web.json_response({"error": str(e)}, status=500)
 
-@app.route('/api/user/create', methods=['POST'])
-def create_user():
+@routes.post('/api/user/create')
+async def create_user(request):
     """Создать VPN ключ для пользователя"""
     try:
-        data = request.json
+        data = await request.json()
         telegram_id = int(data.get('telegram_id'))
         
         # Проверяем, не существует ли уже пользователь
-        user = run_async(get_user_by_telegram_id(telegram_id))
+        user = await get_user_by_telegram_id(telegram_id)
         if user:
-            return jsonify({"error": "У вас уже есть VPN ключ"}), 400
+            return web.json_response({"error": "У вас уже есть VPN ключ"}, status=400)
         
         username = f"user_{telegram_id}"
         
         # Создаем пользователя в Marzban
-        user_data = run_async(marzban.create_user(
+        user_data = await marzban.create_user(
             username=username,
             data_limit_gb=BASE_TARIFF_GB,
             expire_days=BASE_TARIFF_DAYS
-        ))
+        )
         
         if not user_data:
-            return jsonify({"error": "Ошибка при создании ключа"}), 500
+            return web.json_response({"error": "Ошибка при создании ключа"}, status=500)
         
         # Сохраняем в БД
-        run_async(db_create_user(telegram_id, username, "base"))
-        run_async(add_transaction(telegram_id, BASE_TARIFF_PRICE, "base_tariff"))
+        await db_create_user(telegram_id, username, "base", node=marzban.placement(username))
+        await add_transaction(telegram_id, BASE_TARIFF_PRICE, "base_tariff")
         
         # Получаем конфигурацию
-        config = run_async(marzban.get_user_config(username))
+        config = await marzban.get_user_config(username)
         
-        return jsonify({
+        return web.json_response({
             "success": True,
             "username": username,
             "config": config,
@@ -130,58 +238,58 @@ def create_user():
         })
     except Exception as e:
         logging.error(f"Error in create_user: {e}")
-        return jsonify({"error": str(e)}), 500
+        return web.json_response({"error": str(e)}, status=500)
 
-@app.route('/api/user/buy-extra', methods=['POST'])
-def buy_extra():
+@routes.post('/api/user/buy-extra')
+async def buy_extra(request):
     """Купить дополнительные 100 ГБ"""
     try:
-        data = request.json
+        data = await request.json()
         telegram_id = int(data.get('telegram_id'))
         
-        user = run_async(get_user_by_telegram_id(telegram_id))
+        user = await get_user_by_telegram_id(telegram_id)
         if not user:
-            return jsonify({"error": "Пользователь не найден"}), 404
+            return web.json_response({"error": "Пользователь не найден"}, status=404)
         
         username = user["username"]
         
         # Добавляем трафик
-        result = run_async(marzban.add_traffic(username, EXTRA_GB_AMOUNT))
+        result = await marzban.add_traffic(username, EXTRA_GB_AMOUNT)
         if not result:
-            return jsonify({"error": "Ошибка при добавлении трафика"}), 500
+            return web.json_response({"error": "Ошибка при добавлении трафика"}, status=500)
         
         # Сохраняем транзакцию
-        run_async(add_transaction(telegram_id, EXTRA_GB_PRICE, "extra_gb"))
+        await add_transaction(telegram_id, EXTRA_GB_PRICE, "extra_gb")
         
         # Получаем обновленную информацию
-        updated_user = run_async(marzban.get_user(username))
+        updated_user = await marzban.get_user(username)
         limit_gb = updated_user.get("data_limit", 0) / (1024**3) if updated_user else None
         
-        return jsonify({
+        return web.json_response({
             "success": True,
             "new_limit_gb": round(limit_gb, 2) if limit_gb else None
         })
     except Exception as e:
         logging.error(f"Error in buy_extra: {e}")
-        return jsonify({"error": str(e)}), 500
+        return web.json_response({"error": str(e)}, status=500)
 
-@app.route('/api/user/free-mode', methods=['POST'])
-def enable_free():
+@routes.post('/api/user/free-mode')
+async def enable_free(request):
     """Включить бесплатный режим"""
     try:
-        data = request.json
+        data = await request.json()
         telegram_id = int(data.get('telegram_id'))
         
-        user = run_async(get_user_by_telegram_id(telegram_id))
+        user = await get_user_by_telegram_id(telegram_id)
         if not user:
-            return jsonify({"error": "Пользователь не найден"}), 404
+            return web.json_response({"error": "Пользователь не найден"}, status=404)
         
         username = user["username"]
         
         # Переключаем на бесплатный режим
-        result = run_async(marzban.switch_to_free_mode(username))
+        result = await marzban.switch_to_free_mode(username)
         if not result:
-            return jsonify({"error": "Ошибка при переключении на бесплатный режим"}), 500
+            return web.json_response({"error": "Ошибка при переключении на бесплатный режим"}, status=500)
         
         # Вычисляем дату до конца месяца
         now = datetime.now()
@@ -191,25 +299,25 @@ def enable_free():
             end_of_month = datetime(now.year, now.month + 1, 1) - timedelta(days=1)
         
         # Сохраняем в БД
-        run_async(enable_free_mode(telegram_id, end_of_month))
-        run_async(update_user_tariff(telegram_id, "free"))
+        await enable_free_mode(telegram_id, end_of_month)
+        await update_user_tariff(telegram_id, "free")
         
         # Получаем новую конфигурацию
-        config = run_async(marzban.get_user_config(username))
+        config = await marzban.get_user_config(username)
         
-        return jsonify({
+        return web.json_response({
             "success": True,
             "config": config,
             "expire_date": end_of_month.isoformat()
         })
     except Exception as e:
         logging.error(f"Error in enable_free: {e}")
-        return jsonify({"error": str(e)}), 500
+        return web.json_response({"error": str(e)}, status=500)
 
-@app.route('/api/tariffs', methods=['GET'])
-def get_tariffs():
+@routes.get('/api/tariffs')
+async def get_tariffs(request):
     """Получить информацию о тарифах"""
-    return jsonify({
+    return conditional_json_response(request, {
         "base": {
             "gb": BASE_TARIFF_GB,
             "days": BASE_TARIFF_DAYS,
@@ -222,9 +330,113 @@ def get_tariffs():
         "free_mode": {
             "speed_mbps": FREE_MODE_SPEED_MBPS
         }
+    }, CACHE_TARIFFS)
+
+def _check_admin_token(request):
+    """Админские эндпоинты: Authorization: Bearer <ADMIN_API_TOKEN>; без токена в конфигурации - 404"""
+    if not ADMIN_API_TOKEN:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_API_TOKEN}"):
+        raise web.HTTPUnauthorized()
+
+@routes.get('/api/admin/export')
+async def export_data(request):
+    """Выгрузка пользователей или транзакций: ?table=users|transactions&format=csv|jsonl
+    
+    Ответ отдается фрагментами (chunked) по мере чтения БД и страниц Marzban,
+    память воркера не зависит от числа строк.
+    """
+    _check_admin_token(request)
+    
+    table = request.query.get("table", "users")
+    fmt = request.query.get("format", "csv")
+    if table not in EXPORTS or fmt not in FORMATS:
+        return web.json_response({"error": "Неизвестная таблица или формат"}, status=400)
+    
+    response = web.StreamResponse(headers={
+        "Content-Type": f"{FORMATS[fmt]}; charset=utf-8",
+        "Content-Disposition": f'attachment; filename="{table}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}"',
+        "Cache-Control": "no-store"
     })
+    response.enable_chunked_encoding()
+    # gzip, если клиент его принимает
+    response.enable_compression()
+    await response.prepare(request)
+    try:
+        async for chunk in iter_export(table, fmt, marzban):
+            await response.write(chunk)
+    except ConnectionResetError:
+        logging.info(f"Клиент прервал выгрузку {table}")
+        return response
+    except Exception as e:
+        # Заголовки уже отправлены: обрываем ответ без завершающего фрагмента, чтобы клиент увидел ошибку
+        logging.error(f"Ошибка выгрузки {table}: {e}")
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    return response
 
-if __name__ == '__main__':
+@routes.post('/api/admin/users/bulk')
+async def bulk_create_users(request):
+    """Массовое создание ключей: {"telegram_ids": [...]} -> отчет по каждому id"""
+    _check_admin_token(request)
+    try:
+        data = await request.json()
+        telegram_ids = [int(telegram_id) for telegram_id in data.get("telegram_ids") or []]
+    except (ValueError, TypeError, AttributeError):
+        return web.json_response({"error": "Ожидается {\"telegram_ids\": [целые числа]}"}, status=400)
+    if not telegram_ids:
+        return web.json_response({"error": "Пустой список telegram_ids"}, status=400)
+    if len(telegram_ids) > BULK_MAX_USERS:
+        return web.json_response({"error": f"Не больше {BULK_MAX_USERS} пользователей за запрос"}, status=400)
+    
+    report = await provision_users(marzban, telegram_ids)
+    return web.json_response({"summary": summarize(report), "users": report})
+
+async def on_startup(app):
+    # Миграции безопасны при параллельном старте с ботом и другими воркерами
+    await init_db()
+    await marzban.start()
+    marzban.register_metrics()
+    # kill -USR1 <pid воркера> - окно профилирования на PROFILE_SIGNAL_SECONDS
+    profiler.install_signal_handler()
+
+async def on_cleanup(app):
+    """Закрыть пулы соединений Marzban и SQLite"""
+    await marzban.close()
+    await close_db()
+    qr_cache.close()
+
+def create_app():
+    """Фабрика приложения (в том числе для gunicorn с aiohttp.GunicornWebWorker)"""
+    app = web.Application(middlewares=[metrics_middleware, profiling_middleware, cors_middleware])
+    app.add_routes(routes)
+    # У каждого воркера (WEBAPP_WORKERS) свои метрики; порт публичный - только с токеном
+    add_public_metrics_route(app)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def run_worker(reuse_port=False):
+    """Запустить один процесс веб-приложения"""
     logging.basicConfig(level=logging.INFO)
-    app.run(host='127.0.0.1', port=5000, debug=False)
+    web.run_app(create_app(), host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=reuse_port)
+
+def main():
+    """Запуск WEBAPP_WORKERS процессов на одном порту (SO_REUSEPORT)"""
+    if WEBAPP_WORKERS <= 1:
+        run_worker()
+        return
+    
+    workers = [
+        multiprocessing.Process(target=run_worker, kwargs={"reuse_port": True}, name=f"webapp-{i}")
+        for i in range(WEBAPP_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
+if __name__ == '__main__':
+    main()